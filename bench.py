@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# bench.py - Офлайн-бенчмарк рендера стикеров (без токена бота)
+#
+# Генерирует синтетические видео через lavfi (testsrc2) и прогоняет
+# create_sticker_simple по матрице эффект × рамка × текст × профиль × ядра. Для каждого
+# случая пишет время, CPU дочерних процессов, пиковую память FFmpeg и
+# размер результата. Итог - JSON, который можно сравнить с прошлым прогоном:
+#
+#   python3 bench.py --output before.json
+#   python3 bench.py --output after.json --compare before.json
+#
+# Каждый случай запускается в отдельном процессе Python: так пиковая
+# память (ru_maxrss дочерних процессов) относится только к нему.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import asyncio
+import resource
+import platform
+import subprocess
+import tempfile
+from pathlib import Path
+from datetime import datetime
+
+# main.py требует токен при импорте, но в сеть бенчмарк не ходит
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("BOT_MODE", "polling")
+
+REPO_DIR = Path(__file__).resolve().parent
+BENCH_TEXT = "Тест 123"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк рендера стикеров")
+    parser.add_argument("--resolutions", default="640x360,1280x720",
+                        help="Разрешения входа через запятую")
+    parser.add_argument("--durations", default="3",
+                        help="Длительности входа (сек) через запятую")
+    parser.add_argument("--fps", default="30",
+                        help="Частоты кадров входа через запятую")
+    parser.add_argument("--effects", default="",
+                        help="Эффекты через запятую (по умолчанию все)")
+    parser.add_argument("--frames", default="",
+                        help="Рамки через запятую (по умолчанию все)")
+    parser.add_argument("--texts", default="none,text",
+                        help="Варианты текста: none, text")
+    parser.add_argument("--profiles", default="quality",
+                        help="Профили кодирования через запятую (quality, balanced, fast)")
+    parser.add_argument("--cores", default="1",
+                        help="Сколько ядер дать рендеру, через запятую (>1 - параллельное кодирование)")
+    parser.add_argument("--normalized", action="store_true",
+                        help="Рендерить из промежуточного файла (normalize_input)")
+    parser.add_argument("--output", default="bench_results.json",
+                        help="Куда записать JSON с результатами")
+    parser.add_argument("--compare", default="",
+                        help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--run-case", default="", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+# ===== ОДИН СЛУЧАЙ (в отдельном процессе) =====
+async def run_case(case: dict) -> dict:
+    import main
+
+    input_path = Path(case["input"])
+    try:
+        media = await main.probe_media(input_path)
+    except asyncio.TimeoutError:
+        media = None  # Рендер без пробы: квадрат и настройки по умолчанию
+    normalized = False
+    # Как бот: из промежуточного файла, только если он покрывает эффект
+    if case.get("normalized") and main.normalized_covers(media, main.effect_input_span(case["effect"])):
+        normalized_path = Path(tempfile.gettempdir()) / f"bench_norm_{os.getpid()}.mkv"
+        if await main.normalize_input(input_path, normalized_path, media):
+            input_path, normalized = normalized_path, True
+
+    stats = {}
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    success, _, size_kb, webm_data = await main.create_sticker_simple(
+        input_path, None, case["effect"], case["frame"],
+        case["text"], "white", "medium",
+        stats=stats, normalized=normalized, profile=case["profile"], media=media,
+        cores=case["cores"]
+    )
+    wall = time.monotonic() - start
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    if normalized:
+        input_path.unlink(missing_ok=True)
+
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    return {
+        "success": success,
+        "wall_s": round(wall, 3),
+        "child_cpu_s": round(cpu, 3),
+        # На Linux ru_maxrss в килобайтах
+        "peak_rss_mb": round(usage_after.ru_maxrss / 1024, 1),
+        "output_kb": round(len(webm_data) / 1024, 1),
+        "attempts": len(stats.get("attempts", [])),
+        "segments": stats.get("segments", 1),
+        "probe_kb": round(stats.get("probe_kb", 0), 1)
+    }
+
+
+# ===== ПОДГОТОВКА ВХОДОВ =====
+def make_input(ffmpeg: str, out_dir: Path, resolution: str, duration: float, fps: float) -> Path:
+    path = out_dir / f"src_{resolution}_{duration}s_{fps}fps.mp4"
+    if not path.exists():
+        subprocess.run([
+            ffmpeg, "-y", "-loglevel", "error",
+            "-f", "lavfi",
+            "-i", f"testsrc2=size={resolution}:rate={fps}:duration={duration}",
+            "-c:v", "libx264", "-preset", "ultrafast",
+            "-pix_fmt", "yuv420p",
+            str(path)
+        ], check=True)
+    return path
+
+
+def git_commit() -> str:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                cwd=REPO_DIR, capture_output=True, text=True, timeout=5)
+        return result.stdout.strip()
+    except Exception:
+        return ""
+
+
+def ffmpeg_version(ffmpeg: str) -> str:
+    try:
+        result = subprocess.run([ffmpeg, "-version"], capture_output=True, text=True, timeout=5)
+        return result.stdout.split("\n")[0]
+    except Exception:
+        return ""
+
+
+def spawn_case(case: dict, work_dir: Path) -> dict:
+    """Запускает случай в отдельном процессе и читает JSON из последней строки"""
+    result = subprocess.run(
+        [sys.executable, str(Path(__file__).resolve()), "--run-case", json.dumps(case)],
+        cwd=work_dir, capture_output=True, text=True
+    )
+    lines = [line for line in result.stdout.strip().split("\n") if line.startswith("{")]
+    if result.returncode != 0 or not lines:
+        return {"success": False, "error": result.stderr[-300:]}
+    return json.loads(lines[-1])
+
+
+# ===== СВОДКА И СРАВНЕНИЕ =====
+def summarize(results: list, field: str) -> dict:
+    groups = {}
+    for item in results:
+        if item.get("success"):
+            groups.setdefault(item[field], []).append(item)
+    summary = {}
+    for key, items in groups.items():
+        summary[key] = {
+            "cases": len(items),
+            "avg_wall_s": round(sum(i["wall_s"] for i in items) / len(items), 3),
+            "avg_child_cpu_s": round(sum(i["child_cpu_s"] for i in items) / len(items), 3),
+            "max_peak_rss_mb": max(i["peak_rss_mb"] for i in items),
+            "avg_output_kb": round(sum(i["output_kb"] for i in items) / len(items), 1)
+        }
+    return dict(sorted(summary.items(), key=lambda kv: -kv[1]["avg_child_cpu_s"]))
+
+
+def case_key(item: dict) -> tuple:
+    return (item["input"], item["effect"], item["frame"], item["text"],
+            item.get("normalized", False), item.get("profile", "quality"), item.get("cores", 1))
+
+
+def compare(results: list, old_path: Path):
+    old = json.loads(old_path.read_text(encoding="utf-8"))
+    old_cases = {case_key(item): item for item in old["results"] if item.get("success")}
+    print(f"\n📊 Сравнение с {old_path} (коммит {old['meta'].get('commit') or '?'})")
+    print(f"{'случай':60} {'CPU было':>9} {'стало':>9} {'x':>6}")
+    for item in results:
+        before = old_cases.get(case_key(item))
+        if not before or not item.get("success") or not before["child_cpu_s"]:
+            continue
+        ratio = item["child_cpu_s"] / before["child_cpu_s"]
+        name = (f"{Path(item['input']).name} {item['effect']}/{item['frame']}/"
+                f"{item['text'] or '-'}/{item['profile']}/{item.get('cores', 1)}")
+        print(f"{name[:60]:60} {before['child_cpu_s']:9.2f} {item['child_cpu_s']:9.2f} {ratio:6.2f}")
+
+
+# ===== ЗАПУСК =====
+def main():
+    args = parse_args()
+
+    if args.run_case:
+        result = asyncio.run(run_case(json.loads(args.run_case)))
+        print(json.dumps(result))
+        return
+
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        print("❌ FFmpeg не найден!")
+        sys.exit(1)
+
+    output_path = Path(args.output).resolve()
+    compare_path = Path(args.compare).resolve() if args.compare else None
+    start_dir = os.getcwd()
+
+    sys.path.insert(0, str(REPO_DIR))
+    with tempfile.TemporaryDirectory(prefix="sticker_bench_") as tmp:
+        work_dir = Path(tmp)
+        # Импорт main создает ./temp_files - пусть это будет во временной папке
+        os.chdir(work_dir)
+        import main as bot_main
+
+        effects = bot_main.split_list(args.effects) or list(bot_main.VIDEO_EFFECTS)
+        frames = bot_main.split_list(args.frames) or list(bot_main.FRAMES)
+        texts = ["" if t == "none" else BENCH_TEXT for t in bot_main.split_list(args.texts)]
+        profiles = bot_main.split_list(args.profiles)
+        cores_list = [int(c) for c in bot_main.split_list(args.cores)]
+
+        inputs = []
+        for resolution in bot_main.split_list(args.resolutions):
+            for duration in bot_main.split_list(args.durations):
+                for fps in bot_main.split_list(args.fps):
+                    inputs.append(make_input(ffmpeg, work_dir, resolution, float(duration), float(fps)))
+
+        cases = [
+            {"input": str(src), "effect": effect, "frame": frame, "text": text,
+             "profile": profile, "cores": cores, "normalized": args.normalized}
+            for src in inputs for effect in effects for frame in frames for text in texts
+            for profile in profiles for cores in cores_list
+        ]
+
+        print("=" * 60)
+        print(f"🏁 Бенчмарк: {len(inputs)} входов × {len(effects)} эффектов × "
+              f"{len(frames)} рамок × {len(texts)} текстов × {len(profiles)} профилей × "
+              f"{len(cores_list)} вариантов ядер = "
+              f"{len(cases)} случаев")
+        print("=" * 60)
+
+        results = []
+        for n, case in enumerate(cases, start=1):
+            result = spawn_case(case, work_dir)
+            case = dict(case, input=Path(case["input"]).name)
+            results.append({**case, **result})
+            status = "✅" if result.get("success") else "❌"
+            print(f"{status} [{n}/{len(cases)}] {case['input']} {case['effect']}/{case['frame']}/"
+                  f"{'текст' if case['text'] else '-'}/{case['profile']}/{case['cores']}яд: "
+                  f"{result.get('wall_s', 0):.2f}с, CPU {result.get('child_cpu_s', 0):.2f}с, "
+                  f"{result.get('peak_rss_mb', 0):.0f}MB, {result.get('output_kb', 0):.1f}KB")
+
+        os.chdir(start_dir)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "ffmpeg": ffmpeg_version(ffmpeg),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "normalized": args.normalized
+        },
+        "results": results,
+        "by_effect": summarize(results, "effect"),
+        "by_frame": summarize(results, "frame"),
+        "by_profile": summarize(results, "profile"),
+        "by_cores": summarize(results, "cores")
+    }
+
+    output_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    print("\n🎬 Эффекты по CPU (дороже - выше):")
+    for effect, data in report["by_effect"].items():
+        print(f"   {effect:10} CPU {data['avg_child_cpu_s']:6.2f}с  {data['avg_output_kb']:6.1f}KB")
+    print("🖼️ Рамки по CPU:")
+    for frame, data in report["by_frame"].items():
+        print(f"   {frame:10} CPU {data['avg_child_cpu_s']:6.2f}с  {data['avg_output_kb']:6.1f}KB")
+    print("⚙️ Профили по CPU:")
+    for profile, data in report["by_profile"].items():
+        print(f"   {profile:10} CPU {data['avg_child_cpu_s']:6.2f}с  {data['avg_output_kb']:6.1f}KB")
+    print("🧮 Ядра на рендер:")
+    for cores, data in report["by_cores"].items():
+        print(f"   {cores:<10} время {data['avg_wall_s']:6.2f}с  CPU {data['avg_child_cpu_s']:6.2f}с  "
+              f"{data['avg_output_kb']:6.1f}KB")
+    print(f"\n💾 Результаты: {output_path}")
+
+    if compare_path:
+        compare(results, compare_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+# loadtest.py - Нагрузочный тест бота на локальном фейковом Bot API
+#
+# Поднимает aiohttp-сервер, который притворяется Telegram Bot API
+# (getUpdates, getFile, скачивание файлов, sendMessage, editMessageText,
+# sendDocument и т.д.), запускает main.py в режиме polling против него и
+# прогоняет N одновременных пользователей по всему мастеру:
+#
+#   видео → текст или /skip → цвет → размер → эффект → рамка → стикер
+#
+# В конце печатает p50/p95/p99 времени до стикера (от нажатия рамки) и
+# пропускную способность, результаты пишет в JSON.
+#
+#   python3 loadtest.py --users 20
+#   python3 loadtest.py --serve-only   # только фейковый API, бот запускаете сами:
+#   TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_MODE=polling BOT_TOKEN=123:fake python3 main.py
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import subprocess
+import tempfile
+from pathlib import Path
+from datetime import datetime
+
+from aiohttp import web, ClientSession
+
+REPO_DIR = Path(__file__).resolve().parent
+BOT_ID = 100000
+BOT_TOKEN = f"{BOT_ID}:loadtest"
+BOT_USER = {"id": BOT_ID, "is_bot": True, "first_name": "StickerBot", "username": "sticker_loadtest_bot"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота")
+    parser.add_argument("--users", type=int, default=10, help="Одновременных пользователей")
+    parser.add_argument("--rounds", type=int, default=1, help="Стикеров на пользователя")
+    parser.add_argument("--ramp", type=float, default=2.0, help="За сколько секунд запустить всех")
+    parser.add_argument("--api-port", type=int, default=8081, help="Порт фейкового Bot API")
+    parser.add_argument("--bot-port", type=int, default=3001, help="Порт веб-сервера бота (/metrics)")
+    parser.add_argument("--api-latency", type=float, default=0.0,
+                        help="Задержка каждого вызова API, мс (имитация сети)")
+    parser.add_argument("--effects", default="", help="Эффекты через запятую (по умолчанию все)")
+    parser.add_argument("--frames", default="", help="Рамки через запятую (по умолчанию все)")
+    parser.add_argument("--text-ratio", type=float, default=0.5, help="Доля пользователей с текстом")
+    parser.add_argument("--unique", action="store_true",
+                        help="Каждому пользователю свой файл (без попаданий в кэш)")
+    parser.add_argument("--clip", default="", help="Свой видеофайл вместо синтетического")
+    parser.add_argument("--think", type=float, default=0.0,
+                        help="Среднее время на раздумье перед каждым шагом мастера, сек")
+    parser.add_argument("--step-timeout", type=float, default=600, help="Таймаут одного шага, сек")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="loadtest_results.json")
+    parser.add_argument("--serve-only", action="store_true", help="Только фейковый Bot API")
+    parser.add_argument("--no-spawn", action="store_true", help="Бот уже запущен отдельно")
+    return parser.parse_args()
+
+
+# ===== ФЕЙКОВЫЙ BOT API =====
+class BadRequest(Exception):
+    """Ответ 400, как у настоящего Bot API"""
+
+
+class FakeBotAPI:
+    """Минимальная замена Telegram Bot API для локальных тестов"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.updates = []
+        self.update_id = 0
+        self.new_update = asyncio.Event()
+        self.message_id = 0
+        self.messages = {}
+        self.files = {}
+        self.chat_events = {}
+        self.calls = {}
+        self.uploaded_bytes = 0
+        self.documents = set()
+
+    # ----- Сторона пользователя -----
+    def add_file(self, file_id: str, data: bytes):
+        self.files[file_id] = data
+
+    def push_update(self, update: dict):
+        self.update_id += 1
+        update["update_id"] = self.update_id
+        self.updates.append(update)
+        self.new_update.set()
+
+    def events(self, chat_id: int) -> asyncio.Queue:
+        return self.chat_events.setdefault(chat_id, asyncio.Queue())
+
+    def next_message_id(self) -> int:
+        self.message_id += 1
+        return self.message_id
+
+    # ----- HTTP -----
+    def create_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        return app
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        file_id = Path(request.match_info["path"]).stem
+        data = self.files.get(file_id)
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data, content_type="application/octet-stream")
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = {}
+        files = {}
+        if request.method == "POST":
+            form = await request.post()
+            for key, value in form.items():
+                if hasattr(value, "file"):
+                    files[key] = value.file.read()
+                else:
+                    params[key] = value
+
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency and method != "getUpdates":
+            await asyncio.sleep(self.latency / 1000)
+
+        handler = getattr(self, f"api_{method}", None)
+        try:
+            result = await handler(params, files) if handler else True
+        except BadRequest as e:
+            return web.json_response(
+                {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}, status=400
+            )
+        return web.json_response({"ok": True, "result": result})
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        message = {
+            "message_id": self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **fields
+        }
+        self.messages[(chat_id, message["message_id"])] = message
+        return message
+
+    def _emit(self, chat_id: int, method: str, message):
+        self.events(chat_id).put_nowait({"method": method, "message": message, "time": time.monotonic()})
+
+    @staticmethod
+    def _attachment(value, files: dict):
+        """Содержимое загруженного файла (aiogram шлет attach://<поле>)"""
+        if isinstance(value, str) and value.startswith("attach://"):
+            return files.get(value[len("attach://"):])
+        return None
+
+    @staticmethod
+    def _markup(params: dict):
+        markup = params.get("reply_markup")
+        return json.loads(markup) if markup else None
+
+    # ----- Методы -----
+    async def api_getMe(self, params, files):
+        return BOT_USER
+
+    async def api_getUpdates(self, params, files):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    async def api_getFile(self, params, files):
+        file_id = params["file_id"]
+        return {
+            "file_id": file_id,
+            "file_unique_id": f"u_{file_id}",
+            "file_size": len(self.files.get(file_id, b"")),
+            "file_path": f"videos/{file_id}.mp4"
+        }
+
+    async def api_sendMessage(self, params, files):
+        chat_id = int(params["chat_id"])
+        fields = {"text": params.get("text", "")}
+        markup = self._markup(params)
+        # В Message Telegram возвращает только inline-клавиатуру
+        if markup and "inline_keyboard" in markup:
+            fields["reply_markup"] = markup
+        message = self._message(chat_id, **fields)
+        self._emit(chat_id, "sendMessage", message)
+        return message
+
+    async def api_editMessageText(self, params, files):
+        chat_id = int(params["chat_id"])
+        message = self.messages.get((chat_id, int(params["message_id"])))
+        if message is None:
+            message = self._message(chat_id)
+        message["text"] = params.get("text", "")
+        message["edit_date"] = int(time.time())
+        markup = self._markup(params)
+        if markup:
+            message["reply_markup"] = markup
+        else:
+            message.pop("reply_markup", None)
+        self._emit(chat_id, "editMessageText", message)
+        return message
+
+    async def api_sendPhoto(self, params, files):
+        chat_id = int(params["chat_id"])
+        size = len(self._attachment(params.get("photo"), files) or b"")
+        message = self._message(chat_id, caption=params.get("caption", ""), photo=[{
+            "file_id": f"photo_{self.message_id}", "file_unique_id": f"uphoto_{self.message_id}",
+            "width": 640, "height": 480, "file_size": size
+        }])
+        self._emit(chat_id, "sendPhoto", message)
+        return message
+
+    async def api_sendDocument(self, params, files):
+        chat_id = int(params["chat_id"])
+        data = self._attachment(params.get("document"), files)
+        if data is not None:
+            self.uploaded_bytes += len(data)
+            document_id = f"doc_{self.message_id + 1}"
+        else:
+            # Повторная отправка по file_id - без загрузки
+            document_id = params.get("document", "")
+            if document_id not in self.documents:
+                raise BadRequest("wrong file identifier/HTTP URL specified")
+        self.documents.add(document_id)
+        message = self._message(chat_id, caption=params.get("caption", ""), document={
+            "file_id": document_id,
+            "file_unique_id": f"u_{document_id}",
+            "file_name": "sticker.webm",
+            "file_size": len(data) if data is not None else 0
+        })
+        self._emit(chat_id, "sendDocument", message)
+        return message
+
+    async def api_deleteMessage(self, params, files):
+        self.messages.pop((int(params["chat_id"]), int(params["message_id"])), None)
+        return True
+
+
+# ===== ВИРТУАЛЬНЫЙ ПОЛЬЗОВАТЕЛЬ =====
+class SimulatedUser:
+    def __init__(self, api: FakeBotAPI, user_id: int, video_file_id: str, video_size: int,
+                 rng: random.Random, effects: list, frames: list, text_ratio: float,
+                 step_timeout: float, think: float = 0.0):
+        self.api = api
+        self.user_id = user_id
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        self.video_file_id = video_file_id
+        self.video_size = video_size
+        self.rng = rng
+        self.effects = effects
+        self.frames = frames
+        self.text_ratio = text_ratio
+        self.step_timeout = step_timeout
+        self.think = think
+        self.events = api.events(user_id)
+        self.message_id = 0
+
+    def _user_message(self, **fields) -> dict:
+        self.message_id += 1
+        return {
+            "message_id": 10_000_000 + self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self.user,
+            **fields
+        }
+
+    def send_text(self, text: str):
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        self.api.push_update({"message": self._user_message(**fields)})
+
+    def send_video(self):
+        self.api.push_update({"message": self._user_message(video={
+            "file_id": self.video_file_id,
+            "file_unique_id": f"u_{self.video_file_id}",
+            "width": 640, "height": 360, "duration": 3,
+            "file_size": self.video_size
+        })})
+
+    def press(self, message: dict, data: str):
+        self.api.push_update({"callback_query": {
+            "id": f"cb_{self.user_id}_{time.monotonic_ns()}",
+            "from": self.user,
+            "message": message,
+            "chat_instance": str(self.user_id),
+            "data": data
+        }})
+
+    async def wait_for(self, predicate) -> dict:
+        """Ждет исходящее событие бота в этот чат, подходящее под условие"""
+        deadline = time.monotonic() + self.step_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("бот не ответил вовремя")
+            try:
+                event = await asyncio.wait_for(self.events.get(), remaining)
+            except asyncio.TimeoutError:
+                raise TimeoutError("бот не ответил вовремя") from None
+            text = event["message"].get("text") or event["message"].get("caption") or ""
+            if text.startswith(("❌", "😓")):
+                raise RuntimeError(text[:100])
+            if predicate(event):
+                return event
+
+    async def pause(self):
+        """Пользователь думает перед следующим нажатием"""
+        if self.think:
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.think)
+
+    @staticmethod
+    def has_button(prefix: str):
+        def check(event: dict) -> bool:
+            markup = event["message"].get("reply_markup") or {}
+            for row in markup.get("inline_keyboard", []):
+                for button in row:
+                    if button.get("callback_data", "").startswith(prefix):
+                        return True
+            return False
+        return check
+
+    async def run_once(self) -> dict:
+        """Один проход мастера; возвращает тайминги"""
+        wizard_start = time.monotonic()
+
+        self.send_text("📤 Отправить видео")
+        await self.wait_for(lambda e: e["method"] == "sendMessage")
+
+        self.send_video()
+        await self.wait_for(lambda e: "Видео получено" in (e["message"].get("text") or ""))
+
+        await self.pause()
+        if self.rng.random() < self.text_ratio:
+            self.send_text(f"Привет {self.user_id % 1000}")
+        else:
+            self.send_text("/skip")
+        event = await self.wait_for(self.has_button("color_"))
+
+        await self.pause()
+        self.press(event["message"], f"color_white_{self.user_id}")
+        event = await self.wait_for(self.has_button("size_"))
+
+        await self.pause()
+        self.press(event["message"], f"size_medium_{self.user_id}")
+        event = await self.wait_for(self.has_button("effect_"))
+
+        await self.pause()
+        effect = self.rng.choice(self.effects)
+        self.press(event["message"], f"effect_{effect}_{self.user_id}")
+        event = await self.wait_for(self.has_button("frame_"))
+
+        await self.pause()
+        frame = self.rng.choice(self.frames)
+        click = time.monotonic()
+        self.press(event["message"], f"frame_{frame}_{self.user_id}")
+        event = await self.wait_for(lambda e: e["method"] == "sendDocument")
+
+        return {
+            "user": self.user_id,
+            "effect": effect,
+            "frame": frame,
+            "time_to_sticker": event["time"] - click,
+            "wizard_time": event["time"] - wizard_start,
+            "finished": event["time"]
+        }
+
+
+# ===== СТАТИСТИКА =====
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def make_clip(path: Path):
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        print("❌ FFmpeg не найден!")
+        sys.exit(1)
+    subprocess.run([
+        ffmpeg, "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", "testsrc2=size=640x360:rate=30:duration=4",
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+        "-movflags", "+faststart",
+        str(path)
+    ], check=True)
+
+
+async def fetch_metrics(port: int) -> str:
+    try:
+        async with ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                return await response.text()
+    except Exception:
+        return ""
+
+
+# ===== ЗАПУСК =====
+async def run(args):
+    api = FakeBotAPI(latency=args.api_latency)
+    runner = web.AppRunner(api.create_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    print(f"🔌 Фейковый Bot API: {api_url}")
+
+    if args.serve_only:
+        print(f"   Токен для бота: {BOT_TOKEN}")
+        await asyncio.Event().wait()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="sticker_loadtest_"))
+    bot_proc = None
+    bot_log = work_dir / "bot.log"
+    keep_work_dir = True
+    try:
+        clip_path = Path(args.clip) if args.clip else work_dir / "clip.mp4"
+        if not args.clip:
+            make_clip(clip_path)
+        clip = clip_path.read_bytes()
+
+        if not args.no_spawn:
+            env = dict(
+                os.environ,
+                BOT_TOKEN=BOT_TOKEN,
+                BOT_MODE="polling",
+                TELEGRAM_API_URL=api_url,
+                PORT=str(args.bot_port)
+            )
+            with open(bot_log, "wb") as log:
+                bot_proc = subprocess.Popen(
+                    [sys.executable, str(REPO_DIR / "main.py")],
+                    cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT
+                )
+            print(f"🤖 Бот запущен (pid {bot_proc.pid}), лог: {bot_log}")
+
+        # Ждем, пока бот начнет опрашивать getUpdates
+        for _ in range(300):
+            if api.calls.get("getUpdates"):
+                break
+            if bot_proc is not None and bot_proc.poll() is not None:
+                print(f"❌ Бот завершился, см. {bot_log}")
+                return
+            await asyncio.sleep(0.1)
+
+        # Списки эффектов и рамок берем из самого бота (импорт создает ./temp_files в work_dir)
+        os.environ.setdefault("BOT_TOKEN", BOT_TOKEN)
+        os.environ.setdefault("BOT_MODE", "polling")
+        sys.path.insert(0, str(REPO_DIR))
+        start_dir = os.getcwd()
+        os.chdir(work_dir)
+        import main as bot_main
+        os.chdir(start_dir)
+        effects = bot_main.split_list(args.effects) or list(bot_main.VIDEO_EFFECTS)
+        frames = bot_main.split_list(args.frames) or list(bot_main.FRAMES)
+
+        rng = random.Random(args.seed)
+        users = []
+        for n in range(args.users):
+            user_id = 5_000_000 + n
+            file_id = f"video_{n}" if args.unique else "video_shared"
+            # Уникальные файлы: хвост после faststart-MP4 не мешает декодированию
+            data = clip + os.urandom(16) if args.unique else clip
+            api.add_file(file_id, data)
+            users.append(SimulatedUser(api, user_id, file_id, len(data), random.Random(rng.random()),
+                                       effects, frames, args.text_ratio, args.step_timeout,
+                                       args.think))
+
+        print("=" * 60)
+        print(f"🚀 {args.users} пользователей × {args.rounds} стикеров, разгон {args.ramp}с")
+        print("=" * 60)
+
+        results = []
+        errors = []
+
+        async def user_loop(user: SimulatedUser, delay: float):
+            await asyncio.sleep(delay)
+            for _ in range(args.rounds):
+                try:
+                    result = await user.run_once()
+                    results.append(result)
+                    print(f"✅ {user.user_id}: {result['effect']}/{result['frame']} "
+                          f"за {result['time_to_sticker']:.2f}с")
+                except Exception as e:
+                    errors.append({"user": user.user_id, "error": str(e)[:200]})
+                    print(f"❌ {user.user_id}: {str(e)[:100]}")
+
+        start = time.monotonic()
+        await asyncio.gather(*[
+            user_loop(user, args.ramp * i / max(1, args.users)) for i, user in enumerate(users)
+        ])
+        elapsed = time.monotonic() - start
+        bot_metrics = await fetch_metrics(args.bot_port)
+
+        latencies = [r["time_to_sticker"] for r in results]
+        wizard = [r["wizard_time"] for r in results]
+        summary = {
+            "users": args.users,
+            "rounds": args.rounds,
+            "completed": len(results),
+            "errors": len(errors),
+            "elapsed_s": round(elapsed, 2),
+            "throughput_per_min": round(len(results) / elapsed * 60, 2) if elapsed else 0,
+            "time_to_sticker_p50": round(percentile(latencies, 50), 3),
+            "time_to_sticker_p95": round(percentile(latencies, 95), 3),
+            "time_to_sticker_p99": round(percentile(latencies, 99), 3),
+            "wizard_time_p50": round(percentile(wizard, 50), 3),
+            "uploaded_kb": round(api.uploaded_bytes / 1024, 1),
+            "api_calls": api.calls
+        }
+
+        print("\n" + "=" * 60)
+        print(f"📊 Готово: {summary['completed']} стикеров, ошибок {summary['errors']}, "
+              f"{summary['elapsed_s']}с")
+        print(f"⏱ До стикера: p50 {summary['time_to_sticker_p50']}с, "
+              f"p95 {summary['time_to_sticker_p95']}с, p99 {summary['time_to_sticker_p99']}с")
+        print(f"🚚 Пропускная способность: {summary['throughput_per_min']} стикеров/мин")
+        print("=" * 60)
+
+        report = {
+            "meta": {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "cpu_count": os.cpu_count(),
+                "args": vars(args)
+            },
+            "summary": summary,
+            "results": results,
+            "errors": errors,
+            "bot_metrics": bot_metrics
+        }
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"💾 Результаты: {args.output}")
+        if errors:
+            print(f"📝 Лог бота: {bot_log}")
+        else:
+            keep_work_dir = False
+
+    finally:
+        if bot_proc is not None:
+            bot_proc.terminate()
+            try:
+                bot_proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                bot_proc.kill()
+        await runner.cleanup()
+        if not keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    args = parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print("\n👋 Остановлено")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,17 @@ import asyncio
 import tempfile
 import shutil
 from pathlib import Path
-from typing import Tuple, Dict, Optional, List
+from typing import Tuple, Dict, Optional, List, Callable, Awaitable, Any
+from collections import deque, OrderedDict, Counter
 import time
 from datetime import datetime
 import uuid
-import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import re
+import math
+import hashlib
+import json
+import struct
+import zlib
 import logging
 import atexit
 import signal
@@ -28,27 +33,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# ===== KEEP-ALIVE ДЛЯ REPLIT =====
-class KeepAliveHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain; charset=utf-8')
-        self.end_headers()
-        response = f"🎬 Video Sticker Bot\n⏰ {datetime.now().strftime('%H:%M:%S')}"
-        self.wfile.write(response.encode('utf-8'))
-
-    def log_message(self, format, *args):
-        pass
-
-def run_keep_alive():
-    """Запуск keep-alive в отдельном потоке"""
-    try:
-        server = HTTPServer(('0.0.0.0', 3000), KeepAliveHandler)
-        logger.info("🌐 Keep-alive сервер запущен на порту 3000")
-        server.serve_forever()
-    except Exception as e:
-        logger.error(f"❌ Ошибка keep-alive: {e}")
-
 def cleanup():
     """Очистка временных файлов"""
     logger.info("🧹 Очистка временных файлов...")
@@ -59,8 +43,9 @@ def cleanup():
         except Exception as e:
             logger.error(f"Ошибка очистки: {e}")
 
-atexit.register(cleanup)
-signal.signal(signal.SIGTERM, lambda s, f: cleanup())
+def split_list(value: str) -> List[str]:
+    """"a, b,,c" -> ["a", "b", "c"] (списки через запятую в аргументах)"""
+    return [item.strip() for item in value.split(",") if item.strip()]
 
 # Проверяем FFmpeg
 FFMPEG = shutil.which("ffmpeg")
@@ -71,29 +56,57 @@ if not FFMPEG:
 logger.info(f"✅ FFmpeg: {FFMPEG}")
 
 try:
-    from aiogram import Bot, Dispatcher, F, Router
+    from aiogram import Bot, Dispatcher, F, Router, BaseMiddleware
     from aiogram.filters import CommandStart, Command
     from aiogram.types import (
         Message, BufferedInputFile,
         ReplyKeyboardMarkup, KeyboardButton,
         InlineKeyboardMarkup, InlineKeyboardButton,
-        CallbackQuery
+        CallbackQuery, TelegramObject
     )
     from aiogram.enums import ParseMode, ChatAction
     from aiogram.client.session.aiohttp import AiohttpSession
     from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+    from aiogram.exceptions import TelegramBadRequest
+    from aiohttp import web
     logger.info("✅ Aiogram загружен")
 except ImportError as e:
     logger.error(f"❌ Ошибка импорта: {e}")
     sys.exit(1)
 
+# Pillow необязателен: с ним текст рисуется один раз в картинку, без него - drawtext
+try:
+    from PIL import Image, ImageDraw, ImageFont
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN не установлен!")
     sys.exit(1)
 
+# ===== РЕЖИМ РАБОТЫ =====
+# TELEGRAM_API_URL - свой Bot API сервер (например, локальный фейк для тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_URL") or os.getenv("REPLIT_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEB_PORT = int(os.getenv("PORT", "3000"))
+# webhook - если есть публичный https-адрес, иначе polling; BOT_MODE переопределяет
+BOT_MODE = os.getenv("BOT_MODE") or ("webhook" if WEBHOOK_BASE_URL.startswith("https://") else "polling")
+if BOT_MODE not in ("webhook", "polling"):
+    logger.error(f"❌ Неизвестный BOT_MODE: {BOT_MODE}")
+    sys.exit(1)
+
 # Создаем сессию
-session = AiohttpSession()
+if TELEGRAM_API_URL:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    logger.info(f"🔌 Bot API: {TELEGRAM_API_URL}")
+else:
+    session = AiohttpSession()
 bot = Bot(
     token=BOT_TOKEN,
     session=session,
@@ -106,48 +119,805 @@ dp.include_router(router)
 
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
 STICKER_DURATION = 2.9  # 2.9 секунды
+MAX_STICKER_FPS = 30  # Лимит Telegram
+MIN_DECIMATED_FPS = 24  # Реже прореженный ролик уже заметно дергается
+
+# fit - длинная сторона 512, вторая по пропорциям входа (Telegram этого
+# достаточно); square - всегда 512x512 с прозрачными полями
+STICKER_GEOMETRY = os.getenv("STICKER_GEOMETRY", "fit")
+# Короче в режиме fit не делаем (поля прозрачные): на полоске 512x4 не
+# поместились бы ни рамка, ни текст
+MIN_STICKER_SIDE = 128
+if STICKER_GEOMETRY not in ("fit", "square"):
+    logger.error(f"❌ Неизвестный STICKER_GEOMETRY: {STICKER_GEOMETRY}")
+    sys.exit(1)
+
+# Масштаб, поля и частота кадров - общая часть всех рендеров (без пробы входа)
+BASE_FILTERS = [
+    "scale=512:512:force_original_aspect_ratio=decrease",
+    "pad=512:512:(ow-iw)/2:(oh-ih)/2:color=black@0",
+    "fps=30"
+]
 
 # ===== ХРАНИЛИЩЕ =====
+FILE_TTL = int(os.getenv("FILE_TTL_SECONDS", "1800"))  # Файл без обращений живет 30 минут
+USER_DATA_TTL = int(os.getenv("USER_DATA_TTL_SECONDS", "1800"))  # Брошенный мастер
+# Весь диск бота - сумма трех лимитов: STORAGE_MAX_MB (загрузки и их промежуточные файлы),
+# UPLOAD_CACHE_MAX_MB (кэш загрузок) и RENDER_CACHE_MAX_MB (кэш рендера)
+STORAGE_MAX_BYTES = int(os.getenv("STORAGE_MAX_MB", "2048")) * 1024 * 1024
+MAX_FILES_PER_USER = int(os.getenv("MAX_FILES_PER_USER", "3"))
+if MAX_FILES_PER_USER < 1:
+    # При 0 лимит удалял бы и только что загруженное видео
+    logger.error(f"❌ MAX_FILES_PER_USER должен быть не меньше 1: {MAX_FILES_PER_USER}")
+    sys.exit(1)
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL_SECONDS", "60"))
+
+class TimedDict(dict):
+    """dict, который помнит время последнего обращения к каждому ключу"""
+
+    def __init__(self):
+        super().__init__()
+        self.touched = {}
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.touched[key] = time.time()
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.touched[key] = time.time()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.touched.pop(key, None)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        self.touched.pop(key, None)
+        return super().pop(key, *default)
+
+    def idle_keys(self, ttl: float) -> List:
+        now = time.time()
+        return [key for key, touched in self.touched.items() if now - touched > ttl]
+
 class FileStorage:
     def __init__(self):
         self.storage_dir = Path("./temp_files")
         self.storage_dir.mkdir(exist_ok=True)
         self.files = {}
-        self.user_data = {}
+        self.user_data = TimedDict()
         logger.info(f"📁 Хранилище создано")
 
-    def save(self, user_id: int, file_path: Path) -> str:
+    def allocate(self, user_id: int, suffix: str) -> Tuple[str, Path]:
+        """Место под новый файл - скачиваем сразу туда, без копирования"""
         file_id = str(uuid.uuid4())
         user_dir = self.storage_dir / str(user_id)
         user_dir.mkdir(parents=True, exist_ok=True)
-        saved_path = user_dir / f"{file_id}{file_path.suffix}"
-        shutil.copy2(file_path, saved_path)
+        return file_id, user_dir / f"{file_id}{suffix}"
 
+    def add(self, file_id: str, user_id: int, path: Path, content_hash: Optional[str] = None,
+            media: Optional[dict] = None):
+        now = time.time()
         self.files[file_id] = {
-            'path': saved_path,
+            'path': path,
             'user_id': user_id,
-            'time': time.time()
+            'time': now,
+            'accessed': now,
+            'media': media
         }
-        return file_id
+        if content_hash is not None:
+            self.files[file_id]['hash'] = content_hash
+
+        self._enforce_user_cap(user_id, keep=file_id)
+        self._enforce_disk_budget()
 
     def get(self, file_id: str) -> Optional[Path]:
         if file_id in self.files:
+            self.files[file_id]['accessed'] = time.time()
             path = self.files[file_id]['path']
             if path.exists():
                 return path
         return None
 
+    async def content_hash(self, file_id: str) -> Optional[str]:
+        """SHA-256 содержимого файла (считается один раз)"""
+        info = self.files.get(file_id)
+        if info is None:
+            return None
+        if 'hash' not in info:
+            info['hash'] = await asyncio.to_thread(file_sha256, info['path'])
+        return info['hash']
+
     def delete(self, file_id: str):
         if file_id in self.files:
+            info = self.files[file_id]
+            for task in (info.get('normalize_task'), info.get('preview_task'), info.get('speculative_task')):
+                if task is not None and not task.done():
+                    task.cancel()
             try:
-                path = self.files[file_id]['path']
-                if path.exists():
-                    path.unlink()
+                for path in (info['path'], info.get('normalized_path')):
+                    if path is not None and path.exists():
+                        path.unlink()
             except:
                 pass
             del self.files[file_id]
 
+    def start_normalize(self, file_id: str, prepared: Optional[Path] = None) -> Optional[asyncio.Future]:
+        """Запускает фоновую подготовку промежуточного файла 512px.
+
+        prepared - уже готовый промежуточный файл (из кэша загрузок):
+        он просто связывается с записью, FFmpeg не запускается.
+        """
+        info = self.files.get(file_id)
+        if info is None:
+            return None
+        normalized_path = info['path'].with_name(f"{file_id}_norm.mkv")
+        info['normalized_path'] = normalized_path
+        if prepared is not None and prepared.exists():
+            link_or_copy(prepared, normalized_path)
+            info['normalize_task'] = asyncio.get_running_loop().create_future()
+            info['normalize_task'].set_result(normalized_path)
+        else:
+            info['normalize_task'] = asyncio.create_task(
+                normalize_input(info['path'], normalized_path, info['media'])
+            )
+            info['normalize_task'].add_done_callback(self._normalize_done)
+        return info['normalize_task']
+
+    def _normalize_done(self, task: asyncio.Future):
+        # Промежуточный файл появился уже после add - сразу учитываем его в лимите диска
+        if not task.cancelled():
+            self._enforce_disk_budget()
+
+    def media(self, file_id: str) -> Optional[dict]:
+        """Результат probe_media для файла (None - пробы не было)"""
+        info = self.files.get(file_id)
+        return info['media'] if info is not None else None
+
+    async def render_input(self, file_id: str, span: float = 0) -> Tuple[Optional[Path], bool]:
+        """Файл для рендера: промежуточный, если он получился, иначе исходный.
+
+        span - сколько секунд исходника нужно рендеру: промежуточный файл
+        берется, только если он их покрывает. Второе значение - True, если
+        масштаб и fps уже применены.
+        """
+        info = self.files.get(file_id)
+        if info is None:
+            return None, False
+        info['accessed'] = time.time()
+
+        task = info.get('normalize_task')
+        if task is not None and normalized_covers(info['media'], span):
+            try:
+                normalized_path = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+                normalized_path = None
+            if normalized_path is not None and normalized_path.exists():
+                return normalized_path, True
+
+        return self.get(file_id), False
+
+    def start_preview(self, file_id: str):
+        """Запускает построение превью эффектов заранее (один раз на загрузку)"""
+        info = self.files.get(file_id)
+        if info is not None and 'preview_task' not in info:
+            info['preview_task'] = asyncio.create_task(self._build_preview(file_id))
+
+    async def effects_preview(self, file_id: str, timeout: Optional[float] = None) -> Optional[bytes]:
+        """Превью всех эффектов (строится один раз на загрузку).
+
+        Не успело за timeout - None, сборка продолжается в фоне.
+        """
+        self.start_preview(file_id)
+        info = self.files.get(file_id)
+        if info is None:
+            return None
+
+        task = info['preview_task']
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            logger.info(f"🖼 Превью эффектов не готово за {timeout:.0f}с, показываю только кнопки")
+            return None
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            return None
+
+    # ----- Очистка: TTL, лимит на пользователя, общий лимит диска -----
+    def _file_sizes(self) -> Dict[str, int]:
+        """Байты на диске по загрузкам, жесткие ссылки считаются один раз.
+
+        Инод, на который ссылается еще и кэш загрузок, учтен в его лимите;
+        общий инод нескольких загрузок делится между ними поровну.
+        """
+        stats = {}
+        for file_id, info in self.files.items():
+            stats[file_id] = []
+            for path in (info['path'], info.get('normalized_path')):
+                try:
+                    if path is not None:
+                        stats[file_id].append(path.stat())
+                except OSError:
+                    pass
+        refs = Counter((st.st_dev, st.st_ino) for file_stats in stats.values() for st in file_stats)
+
+        sizes = {}
+        for file_id, file_stats in stats.items():
+            sizes[file_id] = 0
+            for st in file_stats:
+                links = refs[(st.st_dev, st.st_ino)]
+                if st.st_nlink > links:
+                    continue  # Остальные ссылки - в кэше загрузок
+                sizes[file_id] += st.st_size // links
+        return sizes
+
+    def total_bytes(self) -> int:
+        return sum(self._file_sizes().values())
+
+    def _enforce_user_cap(self, user_id: int, keep: str):
+        """Оставляет пользователю MAX_FILES_PER_USER последних загрузок.
+
+        keep (только что добавленная) не удаляется, даже если время обращения
+        у нее совпало с другими.
+        """
+        older = sorted(
+            (info['accessed'], file_id)
+            for file_id, info in self.files.items()
+            if info['user_id'] == user_id and file_id != keep
+        )
+        for _, file_id in older[:max(0, len(older) - (MAX_FILES_PER_USER - 1))]:
+            logger.info(f"🧹 Лимит файлов пользователя {user_id}: удаляю {file_id}")
+            self.delete(file_id)
+
+    def _enforce_disk_budget(self) -> int:
+        """Удаляет давно не использованные файлы, пока не влезем в лимит"""
+        sizes = self._file_sizes()
+        total = sum(sizes.values())
+        evicted = 0
+        for file_id in sorted(sizes, key=lambda fid: self.files[fid]['accessed']):
+            if total <= STORAGE_MAX_BYTES:
+                break
+            total -= sizes[file_id]
+            self.delete(file_id)
+            evicted += 1
+        if evicted:
+            logger.info(f"🧹 Лимит диска: удалено файлов {evicted}")
+        return evicted
+
+    def sweep(self) -> dict:
+        """Удаляет просроченные файлы и брошенные сессии мастера"""
+        now = time.time()
+        expired_files = [
+            file_id for file_id, info in self.files.items()
+            if now - info['accessed'] > FILE_TTL
+        ]
+        for file_id in expired_files:
+            self.delete(file_id)
+
+        expired_users = self.user_data.idle_keys(USER_DATA_TTL)
+        for user_id in expired_users:
+            file_id = dict.get(self.user_data, user_id, {}).get('file_id')
+            if file_id:
+                self.delete(file_id)
+            self.user_data.pop(user_id, None)
+
+        evicted = self._enforce_disk_budget()
+        if expired_files or expired_users or evicted:
+            logger.info(
+                f"🧹 Очистка: файлов {len(expired_files)}, сессий {len(expired_users)}, "
+                f"по лимиту диска {evicted}"
+            )
+        return self.stats()
+
+    def stats(self) -> dict:
+        """Сколько сейчас держим в памяти и на диске"""
+        return {
+            'files': len(self.files),
+            'bytes': self.total_bytes(),
+            'user_data': len(self.user_data)
+        }
+
+    async def _build_preview(self, file_id: str) -> Optional[bytes]:
+        input_path, normalized = await self.render_input(file_id)
+        if input_path is None:
+            return None
+        return await create_effects_preview(input_path, normalized, self.media(file_id))
+
+class HashingWriter:
+    """Файл для bot.download_file, который заодно считает SHA-256"""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        return self.f.write(chunk)
+
+    def flush(self):
+        self.f.flush()
+
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def link_or_copy(src: Path, dst: Path):
+    """Жесткая ссылка (данные не копируются); если ФС не умеет - копия"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# ===== КЭШ ЗАГРУЗОК =====
+UPLOAD_CACHE_MAX_BYTES = int(os.getenv("UPLOAD_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+class UploadCache:
+    """Уже скачанные исходники по file_unique_id Telegram (LRU по размеру).
+
+    Популярные GIF и пересланные видео приходят снова и снова с тем же
+    file_unique_id. Файл (и промежуточный, когда он готов) держим жесткой
+    ссылкой: запись пользователя можно удалять, копия в кэше остается.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, unique_id: str) -> Optional[dict]:
+        entry = self.entries.get(unique_id)
+        if entry is not None and not entry['path'].exists():
+            self._remove(unique_id)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(unique_id)
+        self.hits += 1
+        self.bytes_saved += entry['source_size']
+        return entry
+
+    def put(self, unique_id: str, path: Path, content_hash: str, media: Optional[dict] = None):
+        if unique_id in self.entries or self.max_bytes <= 0:
+            return
+        cached_path = self.cache_dir / f"{unique_id}{path.suffix}"
+        cached_path.unlink(missing_ok=True)
+        link_or_copy(path, cached_path)
+        size = cached_path.stat().st_size
+        self.entries[unique_id] = {
+            'path': cached_path,
+            'normalized_path': None,
+            'hash': content_hash,
+            'media': media,
+            'source_size': size,
+            'size': size
+        }
+        self.total_bytes += size
+        self._evict()
+
+    def watch_normalize(self, unique_id: str, task: Optional[asyncio.Future]):
+        """Когда промежуточный файл будет готов - тоже положить его в кэш"""
+        if task is None:
+            return
+
+        def done(finished: asyncio.Future):
+            if finished.cancelled() or finished.exception() is not None:
+                return
+            normalized_path = finished.result()
+            entry = self.entries.get(unique_id)
+            if entry is None or entry['normalized_path'] or normalized_path is None \
+                    or not normalized_path.exists():
+                return
+            cached_path = self.cache_dir / f"{unique_id}_norm.mkv"
+            cached_path.unlink(missing_ok=True)
+            link_or_copy(normalized_path, cached_path)
+            entry['normalized_path'] = cached_path
+            size = cached_path.stat().st_size
+            entry['size'] += size
+            self.total_bytes += size
+            self._evict()
+
+        task.add_done_callback(done)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, unique_id: str):
+        entry = self.entries.pop(unique_id)
+        self.total_bytes -= entry['size']
+        for path in (entry['path'], entry['normalized_path']):
+            if path is not None:
+                path.unlink(missing_ok=True)
+
+# ===== ПРОБА ВХОДА =====
+# ffprobe необязателен: без него те же сведения берутся из заголовка "ffmpeg -i"
+FFPROBE = shutil.which("ffprobe")
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT_SECONDS", "10"))
+MAX_INPUT_SIDE = int(os.getenv("MAX_INPUT_SIDE", "4096"))
+MIN_INPUT_DURATION = 0.1
+ALPHA_PIX_FMTS = ("yuva", "gbrap", "ya", "rgba", "bgra", "argb", "abgr", "pal8")
+# Встроенные декодеры VP8/VP9 теряют альфа-канал WebM, libvpx - нет
+ALPHA_DECODERS = {"vp8": "libvpx", "vp9": "libvpx-vp9"}
+
+PROBE_REJECT_MESSAGES = {
+    "no_video": "в файле не нашлось видео",
+    "size": f"слишком большое разрешение (максимум {MAX_INPUT_SIDE}px по стороне)",
+    "duration": "видео слишком короткое",
+    "timeout": "файл не удалось прочитать вовремя (поврежден или слишком тяжелый)",
+}
+
+def frame_rate_value(value: Optional[str]) -> float:
+    """'30000/1001' или '25' -> кадров в секунду (0 - неизвестно)"""
+    try:
+        num, _, den = (value or "").partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+def media_info(codec: str, width: int, height: int, fps: float, duration: Optional[float],
+               pix_fmt: str, alpha_mode: bool, rotation: float = 0) -> dict:
+    # Видео с телефона часто записано боком и повернуто метаданными -
+    # FFmpeg поворачивает кадр при декодировании, размеры считаем после поворота
+    if round(abs(rotation)) % 180 == 90:
+        width, height = height, width
+    return {
+        'codec': codec,
+        'width': width,
+        'height': height,
+        'fps': round(fps, 3),
+        'duration': duration,
+        'pix_fmt': pix_fmt,
+        'alpha': alpha_mode or pix_fmt.startswith(ALPHA_PIX_FMTS)
+    }
+
+def parse_ffprobe(data: bytes) -> Optional[dict]:
+    try:
+        info = json.loads(data or b"{}")
+    except ValueError:
+        return None
+    streams = info.get("streams") or []
+    if not streams:
+        return None
+    stream = streams[0]
+    try:
+        duration = float(info.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    rotation = stream.get("tags", {}).get("rotate") or 0
+    for side_data in stream.get("side_data_list") or []:
+        rotation = side_data.get("rotation", rotation)
+    return media_info(
+        stream.get("codec_name", ""),
+        int(stream.get("width") or 0),
+        int(stream.get("height") or 0),
+        frame_rate_value(stream.get("avg_frame_rate")) or frame_rate_value(stream.get("r_frame_rate")),
+        duration,
+        stream.get("pix_fmt", ""),
+        str(stream.get("tags", {}).get("alpha_mode", "")) == "1",
+        float(rotation)
+    )
+
+def parse_ffmpeg_banner(text: str) -> Optional[dict]:
+    """То же, что parse_ffprobe, но из вывода "ffmpeg -i" (первый видеопоток)"""
+    video = re.search(r"Stream #\d+:\d+.*?: Video: (\w+)(.*)", text)
+    if video is None:
+        return None
+    details = video.group(2)
+    size = re.search(r", (\d+)x(\d+)", details)
+    pix_fmt = re.search(r", ([a-z0-9_]+)[,(]", details)
+    fps = re.search(r", ([\d.]+) (?:fps|tbr)", details)
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", text)
+    # Метаданные потока идут после его строки, до следующего Stream
+    stream_meta = text[video.end():].split("Stream #", 1)[0]
+    rotation = re.search(r"rotation of (-?[\d.]+) degrees|rotate\s*:\s*(-?\d+)", stream_meta)
+    return media_info(
+        video.group(1),
+        int(size.group(1)) if size else 0,
+        int(size.group(2)) if size else 0,
+        float(fps.group(1)) if fps else 0.0,
+        (int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3)))
+        if duration else None,
+        pix_fmt.group(1) if pix_fmt else "",
+        re.search(r"alpha_mode\s*:\s*1", stream_meta, re.IGNORECASE) is not None,
+        float(rotation.group(1) or rotation.group(2)) if rotation else 0
+    )
+
+async def probe_media(path: Path) -> Optional[dict]:
+    """Кодек, размер, fps, длительность и альфа-канал входа.
+
+    Читается только заголовок, без декодирования - миллисекунды. Если
+    ffprobe завершился с ошибкой, разбирается заголовок "ffmpeg -i".
+    None - видеопотока нет или файл не читается; не уложились
+    в PROBE_TIMEOUT - asyncio.TimeoutError.
+    """
+    async def run_probe() -> Optional[dict]:
+        if FFPROBE:
+            returncode, stdout, stderr = await run_ffmpeg([
+                FFPROBE, "-v", "error",
+                "-select_streams", "v:0",
+                "-show_entries", "stream=codec_name,width,height,avg_frame_rate,r_frame_rate,pix_fmt"
+                                 ":stream_tags=alpha_mode,rotate:stream_side_data=rotation"
+                                 ":format=duration",
+                "-of", "json",
+                str(path)
+            ])
+            if returncode == 0:
+                return parse_ffprobe(stdout)
+            # Сбой самой пробы (скажем, этот ffprobe не знает поле из
+            # -show_entries) - еще не "видео нет": читаем заголовок ffmpeg
+            error = stderr.decode('utf-8', errors='ignore')[-200:]
+            logger.warning(f"🔍 ffprobe вернул код {returncode}, читаю заголовок ffmpeg: {error}")
+        _, _, stderr = await run_ffmpeg([FFMPEG, "-hide_banner", "-i", str(path)])
+        return parse_ffmpeg_banner(stderr.decode('utf-8', errors='ignore'))
+
+    start = time.monotonic()
+    try:
+        media = await asyncio.wait_for(run_probe(), PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"🔍 Проба входа не уложилась в {PROBE_TIMEOUT:.0f}с: {path.name}")
+        raise
+    metrics.observe("sticker_probe_seconds", time.monotonic() - start)
+    if media is not None:
+        logger.info(
+            f"🔍 Вход: {media['codec']} {media['width']}x{media['height']} "
+            f"{media['fps']}fps {media['duration'] or '?'}с"
+            f"{' с альфой' if media['alpha'] else ''} за {time.monotonic() - start:.2f}с"
+        )
+    return media
+
+def media_problem(media: Optional[dict]) -> Optional[str]:
+    """Причина, по которой из входа не выйдет стикер (ключ PROBE_REJECT_MESSAGES)"""
+    if media is None or not media['width'] or not media['height']:
+        return "no_video"
+    if max(media['width'], media['height']) > MAX_INPUT_SIDE:
+        return "size"
+    if media['duration'] is not None and media['duration'] < MIN_INPUT_DURATION:
+        return "duration"
+    return None
+
+def fit_size(media: dict) -> Tuple[int, int]:
+    """Кадр входа, вписанный в 512: длинная сторона 512, вторая по пропорциям (четная)"""
+    width, height = media['width'], media['height']
+    if width >= height:
+        return 512, max(2, round(512 * height / width / 2) * 2)
+    return max(2, round(512 * width / height / 2) * 2), 512
+
+def fit_padded(media: Optional[dict]) -> bool:
+    """Вписанный кадр короче MIN_STICKER_SIDE: в режиме fit добираем его полями"""
+    return STICKER_GEOMETRY == "fit" and media is not None and min(fit_size(media)) < MIN_STICKER_SIDE
+
+def output_size(media: Optional[dict] = None) -> Tuple[int, int]:
+    """Размер стикера: длинная сторона 512, вторая по пропорциям входа (четная).
+
+    Короткая сторона не меньше MIN_STICKER_SIDE. В режиме square и без
+    пробы входа - 512x512.
+    """
+    if STICKER_GEOMETRY == "square" or media is None:
+        return 512, 512
+    width, height = fit_size(media)
+    return max(width, MIN_STICKER_SIDE), max(height, MIN_STICKER_SIDE)
+
+def output_pix_fmt(media: Optional[dict] = None) -> str:
+    """yuva420p, только если в стикере есть прозрачность: альфа входа или поля.
+
+    Альфа-плоскость кодируется отдельным потоком VP9 - без нее быстрее и меньше.
+    """
+    if media is None or media['alpha']:
+        return "yuva420p"
+    if STICKER_GEOMETRY == "square" and media['width'] != media['height']:
+        return "yuva420p"
+    if fit_padded(media):
+        return "yuva420p"
+    return "yuv420p"
+
+def base_filters(media: Optional[dict] = None) -> List[str]:
+    """BASE_FILTERS без шагов, которые входу не нужны.
+
+    Масштаб - только если размер входа не совпадает с output_size, поля -
+    только для неквадратного кадра в режиме square и для узкой полоски в
+    режиме fit, fps - только чтобы
+    проредить вход чаще 30 кадров (дублировать кадры незачем). Без пробы -
+    все три, как раньше.
+    """
+    if media is None:
+        return list(BASE_FILTERS)
+    scale, pad, fps = BASE_FILTERS
+    width, height = media['width'], media['height']
+    filters = []
+    if fit_padded(media):
+        # Узкая полоска: вписываем в output_size и добираем прозрачными полями
+        out_width, out_height = output_size(media)
+        fit_width, fit_height = fit_size(media)
+        filters.append(f"scale={fit_width}:{fit_height}")
+        filters.append(f"pad={out_width}:{out_height}:(ow-iw)/2:(oh-ih)/2:color=black@0")
+    elif STICKER_GEOMETRY == "fit":
+        out_width, out_height = output_size(media)
+        if (width, height) != (out_width, out_height):
+            filters.append(f"scale={out_width}:{out_height}")
+    else:
+        if max(width, height) != 512:
+            filters.append(scale)
+        if (width, height) != (512, 512):
+            filters.append(pad)
+    rate = source_fps(media)
+    if abs(media['fps'] - rate) > 0.01:
+        filters.append(f"fps={rate}")
+    return filters
+
+def decode_args(media: Optional[dict]) -> List[str]:
+    """Параметры декодера (ставятся перед -i) - самый дешевый путь для входа"""
+    if media is None:
+        return []
+    if media['alpha'] and media['codec'] in ALPHA_DECODERS:
+        return ["-c:v", ALPHA_DECODERS[media['codec']]]
+    if media['codec'] == "h264" and min(media['width'], media['height']) >= 1024:
+        # Кадр все равно уменьшится в 2+ раза: деблокинга не видно, а стоит он заметно
+        return ["-skip_loop_filter", "all"]
+    return []
+
+# ===== ПРОМЕЖУТОЧНЫЙ ФАЙЛ =====
+NORMALIZE_SLOTS = int(os.getenv("NORMALIZE_SLOTS", "2"))
+normalize_semaphore = asyncio.Semaphore(NORMALIZE_SLOTS)
+
+async def normalize_input(input_path: Path, output_path: Path,
+                          media: Optional[dict] = None) -> Optional[Path]:
+    """Обрезает, масштабирует и приводит к 30fps исходник один раз.
+
+    Результат - FFV1 без потерь (альфа-канал - только если он нужен), из
+    него потом быстро делаются все варианты стикера. media - результат probe_media: лишние
+    шаги пропускаются. Возвращает None при ошибке.
+    """
+    cmd = [
+        FFMPEG, "-y",
+        "-t", str(NORMALIZE_DURATION),
+        *decode_args(media),
+        "-i", str(input_path),
+        "-an",
+        "-vf", ",".join(base_filters(media)) or "null",
+        "-c:v", "ffv1",
+        "-pix_fmt", output_pix_fmt(media),
+        "-f", "matroska",
+        str(output_path)
+    ]
+    try:
+        async with normalize_semaphore:
+            start = time.monotonic()
+            returncode, _, stderr = await run_ffmpeg(cmd)
+        if returncode != 0:
+            error = stderr.decode('utf-8', errors='ignore')[-300:]
+            logger.error(f"Ошибка подготовки файла: {error}")
+            return None
+        logger.info(
+            f"🧰 Промежуточный файл: {output_path.stat().st_size / 1024:.1f}KB "
+            f"за {time.monotonic() - start:.1f}с"
+        )
+        return output_path
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка подготовки файла: {e}")
+        return None
+
 storage = FileStorage()
+upload_cache = UploadCache(storage.storage_dir / "_uploads", UPLOAD_CACHE_MAX_BYTES)
+
+# ===== МЕТРИКИ =====
+TIME_BUCKETS = [0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120]
+SIZE_BUCKETS_KB = [32, 64, 128, 192, 256, 320, 512, 1024]
+ATTEMPT_BUCKETS = [1, 2, 3, 4, 6]
+
+class Metrics:
+    """Счетчики и гистограммы в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.help: Dict[str, Tuple[str, str]] = {}
+        self.counters: Dict[str, Dict[Tuple, float]] = {}
+        self.histograms: Dict[str, Dict[Tuple, dict]] = {}
+        self.buckets: Dict[str, List[float]] = {}
+
+    def counter(self, name: str, help_text: str):
+        self.help[name] = ("counter", help_text)
+        self.counters.setdefault(name, {})
+
+    def histogram(self, name: str, help_text: str, buckets: List[float]):
+        self.help[name] = ("histogram", help_text)
+        self.histograms.setdefault(name, {})
+        self.buckets[name] = buckets
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.counters[name]
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.buckets[name]
+        series = self.histograms[name].setdefault(
+            key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        )
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    @staticmethod
+    def _labels(key: Tuple, extra: Optional[Tuple] = None) -> str:
+        pairs = list(key) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self, snapshot: Dict[str, Tuple[str, str, float]]) -> str:
+        """Текст для /metrics; snapshot - {имя: (тип, описание, значение)}
+        для величин, которые читаются из состояния бота в момент запроса"""
+        lines = []
+        for name, (metric_type, help_text, value) in snapshot.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}", f"{name} {value}"]
+
+        for name, series in self.counters.items():
+            lines += [f"# HELP {name} {self.help[name][1]}", f"# TYPE {name} counter"]
+            for key, value in series.items():
+                lines.append(f"{name}{self._labels(key)} {value}")
+
+        for name, series in self.histograms.items():
+            buckets = self.buckets[name]
+            lines += [f"# HELP {name} {self.help[name][1]}", f"# TYPE {name} histogram"]
+            for key, data in series.items():
+                for bound, count in zip(buckets, data['buckets']):
+                    lines.append(f"{name}_bucket{self._labels(key, ('le', bound))} {count}")
+                lines.append(f"{name}_bucket{self._labels(key, ('le', '+Inf'))} {data['count']}")
+                lines.append(f"{name}_sum{self._labels(key)} {data['sum']:.6f}")
+                lines.append(f"{name}_count{self._labels(key)} {data['count']}")
+
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("sticker_download_seconds", "Время скачивания исходника", TIME_BUCKETS)
+metrics.histogram("sticker_probe_seconds", "Время пробы входа (ffprobe)", TIME_BUCKETS)
+metrics.histogram("sticker_encode_seconds", "Время рендера стикера", TIME_BUCKETS)
+metrics.histogram("sticker_upload_seconds", "Время отправки стикера в Telegram", TIME_BUCKETS)
+metrics.histogram("sticker_output_kb", "Размер готового стикера, KB", SIZE_BUCKETS_KB)
+metrics.histogram("sticker_encode_attempts", "Попыток кодирования на стикер", ATTEMPT_BUCKETS)
+metrics.counter("sticker_outputs_total", "Готовых стикеров")
+metrics.counter("sticker_outputs_oversize_total", "Стикеров больше лимита Telegram")
+metrics.counter("sticker_render_errors_total", "Ошибок рендера")
+metrics.counter("sticker_encode_profile_total", "Рендеров по профилю кодирования")
+metrics.counter("sticker_encode_parallel_total", "Рендеров по режиму (single/threads/segments)")
+metrics.counter("sticker_admission_rejected_total", "Видео, не принятых из-за перегрузки")
+metrics.counter("sticker_probe_rejected_total", "Видео, отклоненных после пробы")
+metrics.counter("sticker_admission_deferred_total", "Видео, ждавших очереди на скачивание")
+metrics.counter("sticker_rate_limited_total", "Событий сверх лимита частоты")
+metrics.counter("sticker_speculative_total", "Предварительных рендеров (started/hit/miss)")
+
+def record_output(effect: str, frame: str, size_kb: float):
+    """Учет готового стикера: размер и превышение лимита"""
+    metrics.observe("sticker_output_kb", size_kb, effect=effect, frame=frame)
+    metrics.inc("sticker_outputs_total", effect=effect, frame=frame)
+    if size_kb > STICKER_MAX_KB:
+        metrics.inc("sticker_outputs_oversize_total", effect=effect, frame=frame)
 
 # ===== ЗАМЕТНЫЕ ЭФФЕКТЫ КОТОРЫЕ РАБОТАЮТ =====
 VIDEO_EFFECTS = {
@@ -213,6 +983,68 @@ VIDEO_EFFECTS = {
     }
 }
 
+# ===== СКОРОСТЬ ЭФФЕКТОВ =====
+SETPTS_RE = re.compile(r"setpts=([0-9.]+)\*PTS")
+INPUT_SPAN_MARGIN = 0.05  # Запас на последний кадр
+
+def effect_time_scale(effect: str) -> float:
+    """Во сколько раз эффект растягивает время (из setpts в его фильтре)"""
+    effect_filter = VIDEO_EFFECTS.get(effect, {}).get("filter", "")
+    scale = 1.0
+    for factor in SETPTS_RE.findall(effect_filter):
+        scale *= float(factor)
+    return scale
+
+def effect_input_span(effect: str) -> float:
+    """Сколько секунд исходника нужно эффекту, чтобы заполнить стикер"""
+    return round(STICKER_DURATION / effect_time_scale(effect) + INPUT_SPAN_MARGIN, 3)
+
+def equivalent_fps(rate: float) -> float:
+    """Самая низкая частота не выше 30, которая выглядит как rate.
+
+    До 30 кадров частота не меняется (12 остается 12). Чаще - прореживаем
+    через один, через два..., только если вход - целое кратное обычной
+    частоты 24-30 (60 -> 30, 50 -> 25, 72 -> 24): кадры выпадают равномерно.
+    Иначе (37.5 после "Экшена", 45) - просто 30, без потери плавности.
+    """
+    if rate <= 0:
+        return MAX_STICKER_FPS
+    if rate <= MAX_STICKER_FPS:
+        return round(rate, 3)
+    # Допуск 2%: 60.5 от телефона - это те же 60
+    decimated = min(MAX_STICKER_FPS, rate / math.ceil(rate / MAX_STICKER_FPS - 0.02))
+    if decimated >= MIN_DECIMATED_FPS:
+        return round(decimated, 3)
+    return MAX_STICKER_FPS
+
+def source_fps(media: Optional[dict]) -> float:
+    """Частота после базовых фильтров; без пробы - 30, как раньше"""
+    return equivalent_fps(media['fps']) if media and media['fps'] else MAX_STICKER_FPS
+
+def sticker_fps(effect: str, media: Optional[dict]) -> float:
+    """Частота кадров стикера: замедление ее делит, ускорение умножает"""
+    return equivalent_fps(source_fps(media) / effect_time_scale(effect))
+
+def sticker_duration(effect: str, media: Optional[dict]) -> float:
+    """Сколько секунд реально будет в стикере: короткий ролик короче 2.9с"""
+    if media is None or not media['duration']:
+        return STICKER_DURATION
+    return round(min(STICKER_DURATION, media['duration'] * effect_time_scale(effect)), 3)
+
+# Промежуточный FFV1 (без потерь, десятки MB) покрывает эффекты, которым хватает
+# STICKER_DURATION исходника. Ускоряющим ("Быстро", "Экшен") нужно до 2x больше -
+# при длинном исходнике они рендерятся из него, а не из промежуточного файла.
+NORMALIZE_DURATION = max(
+    effect_input_span(effect) for effect in VIDEO_EFFECTS if effect_time_scale(effect) >= 1
+)
+
+def normalized_covers(media: Optional[dict], span: float) -> bool:
+    """Хватит ли промежуточного файла рендеру, которому нужно span секунд исходника"""
+    if span <= NORMALIZE_DURATION:
+        return True
+    # Исходник короче NORMALIZE_DURATION - в промежуточном он целиком
+    return bool(media and media['duration'] and media['duration'] <= NORMALIZE_DURATION)
+
 # ===== ЦВЕТА ТЕКСТА =====
 TEXT_COLORS = {
     "white": "⚪ Белый",
@@ -234,208 +1066,1425 @@ TEXT_SIZES = {
 }
 
 # ===== РАМКИ =====
+# Рамка - RGBA-картинка, которая накладывается одним overlay. Картинка
+# рисуется один раз под размер кадра из полос вдоль краев: (край, толщина,
+# цвет) или (край, толщина, [цвет снаружи, цвет внутри]) для градиента.
+# Цвет - (r, g, b, непрозрачность). Готовый PNG из FRAME_ASSETS_DIR/<ключ>.png
+# имеет приоритет над полосами.
 FRAMES = {
     "none": {
         "name": "🖼️ Без рамки",
-        "filter": "",
+        "bands": [],
         "description": "Без рамки"
     },
     "fire": {
         "name": "🔥 Огненная",
-        "filter": "drawbox=x=0:y=0:w=512:h=15:c=red@0.8:t=fill,"
-                  "drawbox=x=0:y=497:w=512:h=15:c=orange@0.7:t=fill,"
-                  "drawbox=x=0:y=0:w=15:h=512:c=yellow@0.6:t=fill,"
-                  "drawbox=x=497:y=0:w=15:h=512:c=red@0.8:t=fill",
+        "bands": [
+            ("top", 15, (255, 0, 0, 0.8)),
+            ("bottom", 15, (255, 165, 0, 0.7)),
+            ("left", 15, (255, 255, 0, 0.6)),
+            ("right", 15, (255, 0, 0, 0.8))
+        ],
         "description": "Огненная рамка"
     },
     "neon": {
         "name": "💡 Неоновая",
-        "filter": "drawbox=x=0:y=0:w=512:h=8:c=cyan@0.7:t=fill,"
-                  "drawbox=x=0:y=504:w=512:h=8:c=cyan@0.7:t=fill,"
-                  "drawbox=x=0:y=0:w=8:h=512:c=cyan@0.7:t=fill,"
-                  "drawbox=x=504:y=0:w=8:h=512:c=cyan@0.7:t=fill",
+        "bands": [
+            ("top", 8, (0, 255, 255, 0.7)),
+            ("bottom", 8, (0, 255, 255, 0.7)),
+            ("left", 8, (0, 255, 255, 0.7)),
+            ("right", 8, (0, 255, 255, 0.7))
+        ],
         "description": "Неоновая рамка"
     },
     "rainbow": {
         "name": "🌈 Радужная",
-        "filter": "drawbox=x=0:y=0:w=512:h=10:c=red@0.6:t=fill,"
-                  "drawbox=x=0:y=502:w=512:h=10:c=blue@0.6:t=fill,"
-                  "drawbox=x=0:y=0:w=10:h=512:c=green@0.6:t=fill,"
-                  "drawbox=x=502:y=0:w=10:h=512:c=yellow@0.6:t=fill",
+        "bands": [
+            ("top", 10, (255, 0, 0, 0.6)),
+            ("bottom", 10, (0, 0, 255, 0.6)),
+            ("left", 10, (0, 128, 0, 0.6)),
+            ("right", 10, (255, 255, 0, 0.6))
+        ],
         "description": "Радужная рамка"
     }
 }
 
+FRAME_ASSETS_DIR = Path(os.getenv("FRAME_ASSETS_DIR", "frames"))
+# (рамка, ширина, высота) -> готовый PNG в RENDER_TMP_DIR (обычно tmpfs)
+frame_assets: Dict[Tuple[str, int, int], Path] = {}
+ASSETS_DIR_PREFIX = "sticker_assets_"
+
+def process_assets_dir(name: str) -> Path:
+    """Папка этого процесса для картинок рамок и текста в RENDER_TMP_DIR.
+
+    RENDER_TMP_DIR общий для всех процессов (бот, второй экземпляр, bench.py,
+    loadtest.py): в своей папке файл, который читает FFmpeg, никто чужой не
+    удалит и не перепишет. Папка удаляется на выходе, папки умерших
+    процессов - при первом обращении.
+    """
+    root = RENDER_TMP_DIR / f"{ASSETS_DIR_PREFIX}{os.getpid()}"
+    if not root.exists():
+        # os.kill(pid, 0) - проверка, жив ли процесс (на Windows он бы его завершил)
+        stale_dirs = RENDER_TMP_DIR.glob(f"{ASSETS_DIR_PREFIX}*") if os.name == "posix" else []
+        for stale in stale_dirs:
+            try:
+                os.kill(int(stale.name[len(ASSETS_DIR_PREFIX):]), 0)
+            except ProcessLookupError:
+                shutil.rmtree(stale, ignore_errors=True)
+            except (ValueError, OSError):
+                pass
+        root.mkdir(parents=True, exist_ok=True)
+        atexit.register(shutil.rmtree, root, ignore_errors=True)
+    path = root / name
+    path.mkdir(exist_ok=True)
+    return path
+
+def encode_png(width: int, height: int, rgba: bytes) -> bytes:
+    """Минимальный PNG-кодировщик для RGBA (без зависимостей)"""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    stride = width * 4
+    raw = b"".join(b"\x00" + rgba[y * stride:(y + 1) * stride] for y in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+def render_frame_rgba(bands: list, width: int, height: int) -> bytes:
+    """Рисует полосы рамки на прозрачном холсте (наложение "over", как drawbox)"""
+    canvas = bytearray(width * height * 4)
+
+    for edge, thickness, color in bands:
+        outer, inner = (color, color) if isinstance(color[0], int) else color
+        # На узком кадре (fit, 512x4) полоса не толще половины стороны
+        thickness = min(thickness, width // 2, height // 2)
+        for step in range(thickness):
+            # Градиент поперек полосы: от внешнего края к внутреннему
+            t = step / (thickness - 1) if thickness > 1 else 0
+            r, g, b, a = (outer[i] + (inner[i] - outer[i]) * t for i in range(4))
+            if edge == "top":
+                pixels = ((x, step) for x in range(width))
+            elif edge == "bottom":
+                pixels = ((x, height - 1 - step) for x in range(width))
+            elif edge == "left":
+                pixels = ((step, y) for y in range(height))
+            else:
+                pixels = ((width - 1 - step, y) for y in range(height))
+
+            for x, y in pixels:
+                if not (0 <= x < width and 0 <= y < height):
+                    continue
+                i = (y * width + x) * 4
+                dst_a = canvas[i + 3] / 255
+                out_a = a + dst_a * (1 - a)
+                if out_a <= 0:
+                    continue
+                for c, src in enumerate((r, g, b)):
+                    dst = canvas[i + c]
+                    canvas[i + c] = round((src * a + dst * dst_a * (1 - a)) / out_a)
+                canvas[i + 3] = round(out_a * 255)
+
+    return bytes(canvas)
+
+def frame_asset(frame: str, width: int = 512, height: int = 512) -> Optional[Path]:
+    """PNG рамки под размер кадра; строится один раз и переиспользуется"""
+    frame_data = FRAMES.get(frame)
+    if frame_data is None:
+        return None
+
+    custom = FRAME_ASSETS_DIR / f"{frame}.png"
+    if custom.is_file():
+        return custom.resolve()
+    if not frame_data["bands"]:
+        return None
+
+    key = (frame, width, height)
+    path = frame_assets.get(key)
+    if path is not None and path.exists():
+        return path
+
+    path = process_assets_dir("frames") / f"{frame}_{width}x{height}.png"
+    start = time.monotonic()
+    # Через временный файл: тот же размер может строиться в двух потоках сразу
+    tmp_path = path.with_name(f".{uuid.uuid4().hex}.png")
+    tmp_path.write_bytes(encode_png(width, height, render_frame_rgba(frame_data["bands"], width, height)))
+    os.replace(tmp_path, path)
+    frame_assets[key] = path
+    logger.info(f"🖼 Рамка {frame} {width}x{height}: {path.stat().st_size / 1024:.1f}KB "
+                f"за {time.monotonic() - start:.2f}с")
+    return path
+
+async def prepare_frame_asset(frame: str, width: int, height: int) -> Optional[Path]:
+    """frame_asset в отдельном потоке.
+
+    Растеризация полос на Python - десятки миллисекунд на каждый новый
+    размер кадра (в режиме fit их много), цикл событий их не ждет.
+    """
+    path = frame_assets.get((frame, width, height))
+    if path is not None and path.exists():
+        return path
+    return await asyncio.to_thread(frame_asset, frame, width, height)
+
+def prepare_frame_assets():
+    """Заранее строит рамки для стандартного кадра 512x512"""
+    for frame in FRAMES:
+        frame_asset(frame)
+
 # ===== ФУНКЦИЯ ДЛЯ ТЕКСТА =====
+# Цвет текста: (заливка, контур) в RGB
+TEXT_PALETTE = {
+    "white": ((255, 255, 255), (0, 0, 0)),
+    "black": ((0, 0, 0), (255, 255, 255)),
+    "yellow": ((255, 255, 0), (0, 0, 0)),
+    "red": ((255, 0, 0), (255, 255, 255)),
+    "blue": ((0, 0, 255), (255, 255, 255)),
+    "green": ((0, 128, 0), (0, 0, 0)),
+    "pink": ((255, 0, 255), (0, 0, 0)),
+    "orange": ((255, 165, 0), (0, 0, 0))
+}
+
+# Размер текста: (размер шрифта, отступ снизу)
+TEXT_LAYOUT = {
+    "small": (28, 30),
+    "medium": (36, 40),
+    "large": (44, 50),
+    "xlarge": (52, 60)
+}
+
+TEXT_MARGIN = 16  # Отступ текста от краев: шире - картинка текста уменьшается
+TEXT_SPRITE_CACHE = int(os.getenv("TEXT_SPRITE_CACHE", "64"))
+TEXT_FONT = os.getenv("TEXT_FONT") or next((font for font in (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+    "C:/Windows/Fonts/arialbd.ttf"
+) if os.path.exists(font)), None)
+
+# Картинки текста (и файлы для drawtext): ключ -> путь, самые старые удаляются.
+# Путь нужен только на время рендера, а рендеров одновременно не больше
+# RENDER_SLOTS - гораздо меньше размера кэша.
+text_assets: "OrderedDict[Tuple[str, ...], Path]" = OrderedDict()
+
+def sticker_caption(text: str) -> str:
+    """Текст стикера: обрезаем до 25 символов"""
+    text = text.strip()
+    return text[:22] + "..." if len(text) > 25 else text
+
+def cached_text_asset(key: Tuple[str, ...], suffix: str, build: Callable[[Path], None]) -> Path:
+    """Файл для текста из LRU; build(path) создает его при промахе"""
+    path = text_assets.get(key)
+    if path is not None and path.exists():
+        text_assets.move_to_end(key)
+        return path
+
+    # Папка только этого процесса: LRU ниже удаляет лишь свои файлы
+    path = process_assets_dir("text") / (hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16] + suffix)
+    tmp_path = path.with_name(f".{uuid.uuid4().hex}{suffix}")
+    build(tmp_path)
+    os.replace(tmp_path, path)
+    text_assets[key] = path
+
+    while len(text_assets) > TEXT_SPRITE_CACHE:
+        _, old_path = text_assets.popitem(last=False)
+        old_path.unlink(missing_ok=True)
+    return path
+
+def text_sprite(text: str, color: str = "white", size: str = "medium",
+                frame_width: int = 512) -> Optional[Tuple[Path, int]]:
+    """Картинка текста с контуром и отступ снизу; None - Pillow или шрифта нет"""
+    caption = sticker_caption(text)
+    if not caption or not PIL_AVAILABLE or not TEXT_FONT:
+        return None
+
+    font_size, y_offset = TEXT_LAYOUT.get(size, TEXT_LAYOUT["medium"])
+    fill, outline = TEXT_PALETTE.get(color, TEXT_PALETTE["white"])
+
+    def build(path: Path):
+        font = ImageFont.truetype(TEXT_FONT, font_size)
+        stroke = max(2, font_size // 12)
+        left, top, right, bottom = font.getbbox(caption, stroke_width=stroke)
+        sprite = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+        ImageDraw.Draw(sprite).text(
+            (-left, -top), caption, font=font,
+            fill=fill, stroke_width=stroke, stroke_fill=outline
+        )
+        max_width = max(1, frame_width - 2 * TEXT_MARGIN)
+        if sprite.width > max_width:
+            ratio = max_width / sprite.width
+            sprite = sprite.resize((max_width, max(1, round(sprite.height * ratio))), Image.LANCZOS)
+        sprite.save(path, "PNG")
+
+    return cached_text_asset(("sprite", caption, color, size, str(frame_width)), ".png", build), y_offset
+
 def create_text_filter_advanced(text: str, color: str = "white", size: str = "medium") -> str:
-    """Создает фильтр для текста с цветами и размерами"""
-    if not text or len(text.strip()) == 0:
+    """Создает фильтр drawtext (если картинку текста сделать нельзя)"""
+    caption = sticker_caption(text)
+    if not caption:
         return ""
 
-    # Экранируем текст
-    safe_text = text.replace("'", "\\'").replace(":", "\\:")
-    if len(safe_text) > 25:
-        safe_text = safe_text[:22] + "..."
-
-    # Определяем размер
-    if size == "small":
-        font_size = 28
-        y_offset = 30
-    elif size == "large":
-        font_size = 44
-        y_offset = 50
-    elif size == "xlarge":
-        font_size = 52
-        y_offset = 60
-    else:  # medium
-        font_size = 36
-        y_offset = 40
-
-    # Определяем цвет
-    if color == "black":
-        font_color = "black"
-        outline_color = "white"
-    elif color == "white":
-        font_color = "white"
-        outline_color = "black"
-    elif color == "yellow":
-        font_color = "yellow"
-        outline_color = "black"
-    elif color == "red":
-        font_color = "red"
-        outline_color = "white"
-    elif color == "blue":
-        font_color = "blue"
-        outline_color = "white"
-    elif color == "green":
-        font_color = "green"
-        outline_color = "black"
-    elif color == "pink":
-        font_color = "magenta"
-        outline_color = "black"
-    elif color == "orange":
-        font_color = "orange"
-        outline_color = "black"
-    else:
-        font_color = "white"
-        outline_color = "black"
+    font_size, y_offset = TEXT_LAYOUT.get(size, TEXT_LAYOUT["medium"])
+    fill, outline = TEXT_PALETTE.get(color, TEXT_PALETTE["white"])
+
+    # Текст из файла: не нужно экранировать кавычки, двоеточия и %
+    text_file = cached_text_asset(("textfile", caption), ".txt",
+                                  lambda path: path.write_text(caption, encoding="utf-8"))
 
-    # Создаем фильтр с контуром
-    return (f"drawtext=text='{safe_text}':"
-            f"fontcolor={font_color}:"
+    return (f"drawtext=textfile='{text_file}':"
+            f"expansion=none:"
+            f"fontcolor=0x{bytes(fill).hex()}:"
             f"fontsize={font_size}:"
             f"x=(w-text_w)/2:"
             f"y=h-text_h-{y_offset}:"
-            f"box=1:"
-            f"boxcolor={outline_color}@0.3:"
-            f"boxborderw=3")
+            f"borderw={max(2, font_size // 12)}:"
+            f"bordercolor=0x{bytes(outline).hex()}")
+
+# ===== НАСТРОЙКИ КОДИРОВЩИКА =====
+STICKER_MAX_KB = 256  # Лимит Telegram для видео-стикеров
+SIZE_TARGET_FILL = 0.92  # Целимся чуть ниже лимита: libvpx иногда перелетает
+MAX_ENCODE_ATTEMPTS = int(os.getenv("MAX_ENCODE_ATTEMPTS", "4"))
+MIN_BITRATE_KBPS = 40
+STICKER_CRF = 30
+
+# Входят в ключ кэша рендера: при их изменении старые результаты не используются
+ENCODER_SETTINGS = [
+    "-c:v", "libvpx-vp9"
+]
+
+# Профили скорости VP9. На 2.9с 512x512: quality ~10с, balanced ~3.7с
+# (+5% к размеру), fast ~1с (+20% к размеру при том же CRF)
+ENCODER_PROFILES = {
+    "quality": ["-deadline", "good", "-cpu-used", "1"],
+    "balanced": ["-deadline", "good", "-cpu-used", "4"],
+    "fast": ["-deadline", "realtime", "-cpu-used", "6"]
+}
+
+# auto - профиль по очереди рендера, иначе всегда указанный
+ENCODER_PROFILE = os.getenv("ENCODER_PROFILE", "auto")
+if ENCODER_PROFILE != "auto" and ENCODER_PROFILE not in ENCODER_PROFILES:
+    logger.error(f"❌ Неизвестный ENCODER_PROFILE: {ENCODER_PROFILE}")
+    sys.exit(1)
+
+# Задач в ожидании на один слот рендера, с которых включается более быстрый профиль
+PROFILE_BALANCED_BACKLOG = float(os.getenv("PROFILE_BALANCED_BACKLOG", "1"))
+PROFILE_FAST_BACKLOG = float(os.getenv("PROFILE_FAST_BACKLOG", "3"))
+
+def choose_encoder_profile(queued: int, slots: int) -> str:
+    """Профиль кодирования: чем длиннее очередь, тем быстрее"""
+    if ENCODER_PROFILE != "auto":
+        return ENCODER_PROFILE
+    backlog = queued / max(1, slots)
+    if backlog >= PROFILE_FAST_BACKLOG:
+        return "fast"
+    if backlog >= PROFILE_BALANCED_BACKLOG:
+        return "balanced"
+    return "quality"
+
+# Параллельное кодирование одного стикера: auto - потоки libvpx, а при
+# большом числе ядер еще и нарезка на куски; threads - только потоки;
+# off - каждый рендер в один поток
+PARALLEL_ENCODE = os.getenv("PARALLEL_ENCODE", "auto")
+if PARALLEL_ENCODE not in ("auto", "threads", "off"):
+    logger.error(f"❌ Неизвестный PARALLEL_ENCODE: {PARALLEL_ENCODE}")
+    sys.exit(1)
+CPU_COUNT = os.cpu_count() or 1
+MAX_ENCODE_CORES = int(os.getenv("MAX_ENCODE_CORES", str(CPU_COUNT)))
+# Потоки VP9 на 512px упираются в 2-3 ядра; с этого числа ядер режем на куски
+SEGMENT_MIN_CORES = int(os.getenv("SEGMENT_MIN_CORES", "4"))
+# Кусок короче - ключевой кадр в его начале съедает заметную долю размера
+SEGMENT_MIN_SECONDS = float(os.getenv("SEGMENT_MIN_SECONDS", "0.7"))
+
+def choose_encode_cores(queued: int, active: int) -> int:
+    """Сколько ядер отдать рендеру.
+
+    Есть очередь - по ядру на задачу: много рендеров рядом загружают
+    процессор лучше. Очереди нет - ядра делятся между идущими рендерами,
+    и одиночный стикер кодируется параллельно.
+    """
+    if PARALLEL_ENCODE == "off" or queued:
+        return 1
+    return max(1, min(MAX_ENCODE_CORES, CPU_COUNT // max(1, active)))
+
+def encoder_threads_args(threads: int) -> List[str]:
+    """Потоки libvpx: row-mt делит между ними строки блоков, tile-columns 1 -
+    две колонки (512 = 2 x 256, уже libvpx колонки не режет)"""
+    if threads <= 1:
+        return ["-threads", "1"]
+    return ["-threads", str(threads), "-row-mt", "1", "-tile-columns", "1"]
+
+def plan_segments(cores: int, duration: float, fps: float) -> List[Tuple[float, float]]:
+    """Куски стикера (начало, длина) для параллельного кодирования.
+
+    Один кусок - без нарезки. Границы кратны длительности кадра, чтобы
+    склеенные куски шли без пропусков и повторов.
+    """
+    if PARALLEL_ENCODE != "auto" or cores < SEGMENT_MIN_CORES:
+        return [(0.0, duration)]
+    count = min(cores // 2, int(duration / SEGMENT_MIN_SECONDS))
+    frames = round(duration * fps)
+    if count < 2 or frames < count:
+        return [(0.0, duration)]
+    starts = [round(frames * i / count) / fps for i in range(count)]
+    ends = starts[1:] + [duration]
+    return [(round(start, 4), round(end - start, 4)) for start, end in zip(starts, ends)]
+
+async def run_segmented(cmds: List[List[str]], parts: List[Path], output_path: Path) -> Tuple[int, bytes]:
+    """Кодирует куски параллельно и склеивает их в один WebM без перекодирования"""
+    results = await asyncio.gather(*(run_ffmpeg(cmd) for cmd in cmds))
+    for returncode, _, stderr in results:
+        if returncode != 0:
+            return returncode, stderr
+    list_path = output_path.with_suffix(".txt")
+    list_path.write_text("".join(f"file '{part}'\n" for part in parts), encoding="utf-8")
+    try:
+        returncode, _, stderr = await run_ffmpeg([
+            FFMPEG, "-y",
+            "-f", "concat", "-safe", "0",
+            "-i", str(list_path),
+            "-c", "copy",
+            "-f", "webm",
+            str(output_path)
+        ])
+    finally:
+        list_path.unlink(missing_ok=True)
+    return returncode, stderr
+
+# Быстрая пробная кодировка для оценки сложности видео
+PROBE_SETTINGS = [
+    "-c:v", "libvpx-vp9",
+    "-crf", str(STICKER_CRF),
+    "-b:v", "0",
+    "-deadline", "realtime",
+    "-cpu-used", "8"
+]
+
+def target_bitrate_kbps(duration: float = STICKER_DURATION) -> int:
+    """Битрейт, при котором стикер укладывается в лимит с запасом"""
+    target_bits = STICKER_MAX_KB * 1024 * 8 * SIZE_TARGET_FILL
+    return int(target_bits / duration / 1000)
+
+def rate_control_args(mode: str, bitrate_kbps: int) -> List[str]:
+    """Аргументы управления битрейтом для попытки кодирования"""
+    if mode == "cq":
+        # Constrained quality: качество по CRF, битрейт не выше заданного
+        return ["-crf", str(STICKER_CRF), "-b:v", f"{bitrate_kbps}k"]
+    # VBR: кодировщик сам распределяет заданный битрейт
+    return ["-b:v", f"{bitrate_kbps}k", "-maxrate", f"{int(bitrate_kbps * 1.2)}k"]
+
+async def run_ffmpeg(cmd: List[str]) -> Tuple[int, bytes, bytes]:
+    """Запускает FFmpeg и убивает процесс, если задачу отменили"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    return proc.returncode, stdout, stderr
+
+# ===== СБОРКА ФИЛЬТРА =====
+def build_video_filter(effect: str, frame: str, text: str, text_color: str,
+                       text_size: str, normalized: bool = False,
+                       pads: Optional[Tuple[str, str]] = None,
+                       media: Optional[dict] = None) -> str:
+    """Граф фильтров: база (если нужна), эффект, рамка (overlay), текст.
+
+    pads - метки входа и выхода для -filter_complex; без них строка для -vf.
+    media - проба входа: по ней размер кадра, и из базы выпадают ненужные
+    масштаб и fps.
+    """
+    width, height = output_size(media)
+    # Базовый фильтр (для промежуточного файла уже применен)
+    pre = [] if normalized else base_filters(media)
+
+    # Добавляем эффект
+    if effect in VIDEO_EFFECTS:
+        effect_filter = VIDEO_EFFECTS[effect]["filter"]
+        if effect_filter:
+            pre.append(effect_filter)
+    # Итоговая частота после эффекта скорости: без нее FFmpeg дублирует или
+    # выбрасывает кадры под частоту входа
+    pre.append(f"fps={sticker_fps(effect, media)}")
+
+    # Картинки поверх кадра: рамка, затем текст. Каждая читается один раз,
+    # overlay повторяет ее на всех кадрах.
+    overlays = []
+    frame_path = frame_asset(frame, width, height)
+    if frame_path is not None:
+        # Свой PNG из FRAME_ASSETS_DIR может быть другого размера - подгоняем
+        overlays.append((frame_path, "0:0", f",scale={width}:{height}"))
+
+    post = []
+    if text:
+        sprite = text_sprite(text, text_color, text_size, width)
+        if sprite is not None:
+            sprite_path, y_offset = sprite
+            overlays.append((sprite_path, f"(W-w)/2:H-h-{y_offset}", ""))
+        else:
+            text_filter = create_text_filter_advanced(text, text_color, text_size)
+            if text_filter:
+                post.append(text_filter)
+
+    if not overlays:
+        # Пустой -vf ffmpeg не принимает (промежуточный файл без эффекта и рамки)
+        chain = ",".join(pre + post) or "null"
+        return f"[{pads[0]}]{chain}[{pads[1]}]" if pads else chain
+
+    src, dst = pads or ("in", "out")
+    graph = [f"movie='{path}'{fit}[{dst}_o{i}]" for i, (path, _, fit) in enumerate(overlays)]
+    if pre:
+        graph.append(f"[{src}]{','.join(pre)}[{dst}_base]")
+        src = f"{dst}_base"
+    for i, (_, position, _) in enumerate(overlays):
+        last = i == len(overlays) - 1
+        chain = ",".join([f"overlay={position}:format=auto"] + (post if last else []))
+        graph.append(f"[{src}][{dst}_o{i}]{chain}[{dst if last else f'{dst}_m{i}'}]")
+        src = f"{dst}_m{i}"
+    return ";".join(graph)
+
+def build_result_message(effect: str, frame: str, text: str, text_color: str,
+                         text_size: str, size_kb: float,
+                         dimensions: Tuple[int, int] = (512, 512),
+                         duration: float = STICKER_DURATION, fps: float = MAX_STICKER_FPS) -> str:
+    """Подпись к готовому стикеру"""
+    result_msg = f"✅ <b>Стикер создан!</b>\n\n"
+
+    # Эффект
+    effect_name = VIDEO_EFFECTS.get(effect, {}).get("name", effect)
+    effect_desc = VIDEO_EFFECTS.get(effect, {}).get("description", "")
+    result_msg += f"🎬 <b>Эффект:</b> {effect_name}\n"
+    result_msg += f"📝 <i>{effect_desc}</i>\n"
+
+    # Рамка
+    frame_name = FRAMES.get(frame, {}).get("name", frame)
+    result_msg += f"🖼️ <b>Рамка:</b> {frame_name}\n"
+
+    if text:
+        result_msg += f"📝 <b>Текст:</b> {text[:20]}{'...' if len(text) > 20 else ''}\n"
+        result_msg += f"🎨 <b>Цвет:</b> {TEXT_COLORS.get(text_color, 'Белый')}\n"
+        result_msg += f"📏 <b>Размер:</b> {TEXT_SIZES.get(text_size, 'Средний')}\n"
+
+    result_msg += f"📦 <b>Размер файла:</b> {size_kb:.1f}KB / {STICKER_MAX_KB}KB\n"
+    result_msg += f"📐 <b>Разрешение:</b> {dimensions[0]}x{dimensions[1]}\n"
+    result_msg += f"⏱ <b>Длительность:</b> {duration:g}с, {fps:g} кадров/с\n"
+
+    if size_kb <= STICKER_MAX_KB:
+        result_msg += f"\n🎉 <b>Соответствует требованиям Telegram!</b>"
+    else:
+        result_msg += f"\n⚠️ <b>Слишком большой, но можно попробовать отправить</b>"
+
+    return result_msg
 
 # ===== ФУНКЦИЯ СОЗДАНИЯ СТИКЕРА =====
+# Выход FFmpeg: WebM нужен с Duration и Cues, а их муксер пишет только в файл
+# с перемоткой (в pipe:1 получается "живой" поток без длительности). Поэтому
+# пишем файл в памяти (tmpfs), если он есть, и сразу забираем байты.
+RENDER_TMP_DIR = Path("/dev/shm") if os.access("/dev/shm", os.W_OK) else Path(tempfile.gettempdir())
+
 async def create_sticker_simple(
     input_path: Path,
-    output_path: Path,
+    output_path: Optional[Path] = None,
     effect: str = "none",
     frame: str = "none",
     text: str = "",
     text_color: str = "white",
-    text_size: str = "medium"
-) -> Tuple[bool, str, int]:
-    """Функция создания стикера"""
+    text_size: str = "medium",
+    stats: Optional[Dict] = None,
+    normalized: bool = False,
+    profile: Optional[str] = None,
+    media: Optional[dict] = None,
+    cores: Optional[int] = None
+) -> Tuple[bool, str, int, bytes]:
+    """Функция создания стикера.
+
+    Размер подбирается под лимит Telegram: быстрая проба оценивает
+    сложность видео, затем битрейт уменьшается, пока файл не влезет.
+    Попытки (режим, битрейт, размер, время) и профиль пишутся в лог и в stats.
+    normalized=True - вход уже масштабирован normalize_input.
+    profile - профиль из ENCODER_PROFILES; None - по текущей очереди рендера.
+    media - проба исходника: размер кадра, альфа-канал, путь декодирования.
+    cores - сколько ядер можно занять; None - по очереди рендера. Больше
+    одного - потоки libvpx, а при SEGMENT_MIN_CORES - куски параллельно.
+    Возвращает байты WebM; output_path - если нужен еще и файл.
+    """
+    work_path = RENDER_TMP_DIR / f"sticker_{uuid.uuid4().hex}.webm"
+    encode_start = time.monotonic()
+    if profile is None:
+        profile = choose_encoder_profile(render_scheduler.queued, render_scheduler.slots)
+    if cores is None:
+        cores = choose_encode_cores(render_scheduler.queued, render_scheduler.active)
+    part_paths = []
     try:
-        logger.info(f"🎬 Создаю стикер: эффект={effect}, рамка={frame}")
+        logger.info(f"🎬 Создаю стикер: эффект={effect}, рамка={frame}, профиль={profile}, ядер={cores}")
+        metrics.inc("sticker_encode_profile_total", profile=profile)
+
+        # Рамку строим заранее в потоке - build_video_filter возьмет ее из frame_assets
+        await prepare_frame_asset(frame, *output_size(media))
+        video_filter = build_video_filter(effect, frame, text, text_color, text_size, normalized,
+                                          media=media)
+        duration = sticker_duration(effect, media)
+        time_scale = effect_time_scale(effect)
+
+        def input_cmd(start: float, length: float) -> List[str]:
+            """Команда до параметров кодировщика для отрезка стикера [start, start + length)"""
+            return [
+                FFMPEG, "-y",
+                # Отрезок стикера -> отрезок исходника с учетом скорости эффекта
+                *(["-ss", str(round(start / time_scale, 4))] if start else []),
+                "-t", str(round(length / time_scale + INPUT_SPAN_MARGIN, 3)),
+                # Промежуточный файл - FFV1, ему особый декодер не нужен
+                *([] if normalized else decode_args(media)),
+                "-i", str(input_path),
+                "-t", str(length),
+                "-an",
+                "-vf", video_filter,
+                "-pix_fmt", output_pix_fmt(media)
+            ]
+
+        base_cmd = input_cmd(0, duration)
+        segments = plan_segments(cores, duration, sticker_fps(effect, media))
+        if len(segments) > 1:
+            part_paths = [work_path.with_name(f"{work_path.stem}_{i}.webm") for i in range(len(segments))]
+        threads = encoder_threads_args(max(1, cores // len(segments)))
+        metrics.inc("sticker_encode_parallel_total",
+                    mode="segments" if part_paths else "threads" if cores > 1 else "single")
+
+        # Пробная быстрая кодировка: оцениваем, сколько весит видео при CRF
+        limit_bytes = STICKER_MAX_KB * 1024
+        target_bytes = limit_bytes * SIZE_TARGET_FILL
+        probe_start = time.monotonic()
+        returncode, probe_data, stderr = await run_ffmpeg(
+            base_cmd + PROBE_SETTINGS + encoder_threads_args(cores) + ["-f", "webm", "pipe:1"]
+        )
+        if returncode != 0:
+            error = stderr.decode('utf-8', errors='ignore')[-300:]
+            logger.error(f"FFmpeg ошибка: {error}")
+            metrics.inc("sticker_render_errors_total", effect=effect)
+            return False, f"❌ Ошибка FFmpeg", 0, b''
+        probe_kb = len(probe_data) / 1024
+        logger.info(f"🎯 Проба: {probe_kb:.1f}KB за {time.monotonic() - probe_start:.1f}с")
+
+        # Простое видео кодируем по качеству, сложное - сразу в целевой битрейт
+        mode = "cq" if len(probe_data) <= target_bytes else "vbr"
+        # Битрейт - по реальной длительности: короткому ролику достается весь лимит
+        bitrate_kbps = target_bitrate_kbps(duration)
+        attempts = []
+        if stats is not None:
+            stats['profile'] = profile
+            stats['fps'] = sticker_fps(effect, media)
+            stats['duration'] = duration
+            stats['cores'] = cores
+            stats['segments'] = len(segments)
+            stats['probe_kb'] = probe_kb
+            stats['attempts'] = attempts
+
+        encoder = ENCODER_SETTINGS + ENCODER_PROFILES[profile] + threads
+        for attempt in range(1, MAX_ENCODE_ATTEMPTS + 1):
+            output_args = encoder + rate_control_args(mode, bitrate_kbps) + ["-f", "webm"]
+            attempt_start = time.monotonic()
+            if part_paths:
+                returncode, stderr = await run_segmented(
+                    [input_cmd(start, length) + output_args + [str(part)]
+                     for (start, length), part in zip(segments, part_paths)],
+                    part_paths, work_path
+                )
+            else:
+                returncode, _, stderr = await run_ffmpeg(base_cmd + output_args + [str(work_path)])
+            if returncode != 0 or not work_path.exists():
+                break
+
+            output_bytes = work_path.stat().st_size
+            attempts.append({
+                'mode': mode,
+                'bitrate_kbps': bitrate_kbps,
+                'size_kb': output_bytes / 1024,
+                'seconds': time.monotonic() - attempt_start
+            })
+            logger.info(
+                f"🎯 Попытка {attempt}: {mode} {bitrate_kbps}k → "
+                f"{output_bytes / 1024:.1f}KB за {attempts[-1]['seconds']:.1f}с"
+            )
+            if output_bytes <= limit_bytes or bitrate_kbps <= MIN_BITRATE_KBPS:
+                break
+
+            # Перелет: уменьшаем битрейт пропорционально (с запасом) и переходим в VBR
+            mode = "vbr"
+            bitrate_kbps = max(MIN_BITRATE_KBPS, int(bitrate_kbps * target_bytes / output_bytes * 0.95))
+
+        if returncode == 0 and work_path.exists():
+            webm_data = work_path.read_bytes()
+            size_kb = len(webm_data) / 1024
+            if output_path is not None:
+                output_path.write_bytes(webm_data)
+
+            metrics.observe("sticker_encode_seconds", time.monotonic() - encode_start,
+                            effect=effect, frame=frame, profile=profile)
+            metrics.observe("sticker_encode_attempts", len(attempts), effect=effect)
+            record_output(effect, frame, size_kb)
+
+            result_msg = build_result_message(effect, frame, text, text_color, text_size, size_kb,
+                                              output_size(media), duration,
+                                              sticker_fps(effect, media))
+            return True, result_msg, int(size_kb), webm_data
+        else:
+            error = stderr.decode('utf-8', errors='ignore')[-300:]
+            logger.error(f"FFmpeg ошибка: {error}")
+            metrics.inc("sticker_render_errors_total", effect=effect)
+            return False, f"❌ Ошибка FFmpeg", 0, b''
 
-        # Базовый фильтр
-        filters = [
-            "scale=512:512:force_original_aspect_ratio=decrease",
-            "pad=512:512:(ow-iw)/2:(oh-ih)/2:color=black@0",
-            "fps=30"
-        ]
+    except Exception as e:
+        logger.error(f"🔥 Ошибка в create_sticker_simple: {e}")
+        return False, f"❌ Ошибка: {str(e)[:100]}", 0, b''
+    finally:
+        work_path.unlink(missing_ok=True)
+        for part in part_paths:
+            part.unlink(missing_ok=True)
+
+# ===== НЕСКОЛЬКО ЭФФЕКТОВ ЗА ОДИН ПРОХОД =====
+MULTI_EFFECT = "all"
+MULTI_EFFECT_DATA = {
+    "name": "🎞 Все эффекты сразу",
+    "description": f"{len(VIDEO_EFFECTS)} стикеров за один проход"
+}
 
-        # Добавляем эффект
-        if effect in VIDEO_EFFECTS:
-            effect_filter = VIDEO_EFFECTS[effect]["filter"]
-            if effect_filter:
-                filters.append(effect_filter)
+async def create_stickers_multi(
+    input_path: Path,
+    effects: List[str],
+    frame: str = "none",
+    text: str = "",
+    text_color: str = "white",
+    text_size: str = "medium",
+    normalized: bool = False,
+    media: Optional[dict] = None
+) -> Dict[str, Tuple[bool, str, int, bytes]]:
+    """Рендер нескольких эффектов одним процессом FFmpeg.
+
+    Вход декодируется один раз, split раздает кадры по веткам эффектов,
+    у каждой ветки свой выход WebM. Ветки, не влезшие в лимит, отдельно
+    перекодируются create_sticker_simple с подбором битрейта.
+    """
+    results = {}
+    profile = choose_encoder_profile(render_scheduler.queued, render_scheduler.slots)
+    try:
+        logger.info(f"🎞 Создаю {len(effects)} стикеров за проход: рамка={frame}, профиль={profile}")
+        metrics.inc("sticker_encode_profile_total", profile=profile)
+        with tempfile.TemporaryDirectory(dir=RENDER_TMP_DIR) as tmp_dir:
+            outputs = [Path(tmp_dir) / f"{effect}.webm" for effect in effects]
+
+            await prepare_frame_asset(frame, *output_size(media))
+            base_filter = "".join(f"{f}," for f in ([] if normalized else base_filters(media)))
+            labels = "".join(f"[s{i}]" for i in range(len(effects)))
+            graph = [f"[0:v]{base_filter}split={len(effects)}{labels}"]
+            for i, effect in enumerate(effects):
+                graph.append(build_video_filter(effect, frame, text, text_color, text_size,
+                                                normalized=True, pads=(f"s{i}", f"v{i}"),
+                                                media=media))
+
+            cmd = [
+                FFMPEG, "-y",
+                "-t", str(max(effect_input_span(effect) for effect in effects)),
+                *([] if normalized else decode_args(media)),
+                "-i", str(input_path),
+                "-filter_complex", ";".join(graph)
+            ]
+            for i, output_path in enumerate(outputs):
+                cmd += [
+                    "-map", f"[v{i}]",
+                    "-t", str(sticker_duration(effects[i], media)),
+                    "-an",
+                    *ENCODER_SETTINGS,
+                    "-pix_fmt", output_pix_fmt(media),
+                    *ENCODER_PROFILES[profile],
+                    *rate_control_args("cq", target_bitrate_kbps(sticker_duration(effects[i], media))),
+                    "-f", "webm",
+                    str(output_path)
+                ]
+
+            start = time.monotonic()
+            returncode, _, stderr = await run_ffmpeg(cmd)
+            if returncode != 0:
+                error = stderr.decode('utf-8', errors='ignore')[-300:]
+                logger.error(f"FFmpeg ошибка: {error}")
+                metrics.inc("sticker_render_errors_total", effect=MULTI_EFFECT)
+                return {effect: (False, f"❌ Ошибка FFmpeg", 0, b'') for effect in effects}
+            elapsed = time.monotonic() - start
+            metrics.observe("sticker_encode_seconds", elapsed, effect=MULTI_EFFECT, frame=frame,
+                            profile=profile)
+            logger.info(f"🎞 Проход на {len(effects)} выходов: {elapsed:.1f}с")
+
+            for effect, output_path in zip(effects, outputs):
+                webm_data = output_path.read_bytes() if output_path.exists() else b''
+                if not webm_data:
+                    # Ветка ничего не записала - остальные эффекты все равно отдаем
+                    logger.error(f"FFmpeg: пустой выход для эффекта {effect}")
+                    metrics.inc("sticker_render_errors_total", effect=effect)
+                    results[effect] = (False, f"❌ Ошибка FFmpeg", 0, b'')
+                    continue
+                size_kb = len(webm_data) / 1024
+                if size_kb > STICKER_MAX_KB:
+                    # Эта ветка не влезла - кодируем ее отдельно с подбором размера
+                    results[effect] = await create_sticker_simple(
+                        input_path, None, effect, frame, text, text_color, text_size,
+                        normalized=normalized, profile=profile, media=media
+                    )
+                    continue
+                record_output(effect, frame, size_kb)
+                results[effect] = (
+                    True,
+                    build_result_message(effect, frame, text, text_color, text_size, size_kb,
+                                         output_size(media), sticker_duration(effect, media),
+                                         sticker_fps(effect, media)),
+                    int(size_kb),
+                    webm_data
+                )
+        return results
 
-        # Рамка
-        if frame in FRAMES:
-            frame_filter = FRAMES[frame]["filter"]
-            if frame_filter:
-                filters.append(frame_filter)
+    except Exception as e:
+        logger.error(f"🔥 Ошибка в create_stickers_multi: {e}")
+        return {effect: (False, f"❌ Ошибка: {str(e)[:100]}", 0, b'') for effect in effects}
+
+# ===== ОЧЕРЕДЬ РЕНДЕРА =====
+class RenderScheduler:
+    """Ограниченное число слотов FFmpeg и честная очередь по пользователям.
+
+    У каждого пользователя своя FIFO-очередь, очереди обслуживаются по кругу
+    (round-robin), поэтому один активный пользователь не блокирует остальных.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        self.active = 0
+        self.queues: Dict[int, deque] = {}
+        self.order: deque = deque()  # Пользователи в порядке обхода
+        self._notify_tasks = set()
+        logger.info(f"🎛 Планировщик рендера: {self.slots} слотов")
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def pending_order(self) -> List[dict]:
+        """Порядок, в котором будут запущены ожидающие задачи"""
+        queues = [self.queues[uid] for uid in self.order]
+        result = []
+        depth = max((len(queue) for queue in queues), default=0)
+        for i in range(depth):
+            for queue in queues:
+                if i < len(queue):
+                    result.append(queue[i])
+        return result
+
+    async def run(self, user_id: int, job_factory: Callable[[], Awaitable], on_position=None,
+                  weight: int = 1):
+        """Ставит задачу в очередь пользователя и ждет ее результат.
+
+        weight - сколько слотов занимает задача (рендер нескольких эффектов
+        за проход - несколько кодировщиков сразу), но не больше всех слотов.
+        """
+        job = {
+            'factory': job_factory,
+            'future': asyncio.get_running_loop().create_future(),
+            'on_position': on_position,
+            'position': None,
+            'task': None,
+            'weight': min(max(1, weight), self.slots)
+        }
 
-        # Текст
-        if text:
-            text_filter = create_text_filter_advanced(text, text_color, text_size)
-            if text_filter:
-                filters.append(text_filter)
+        if user_id not in self.queues:
+            self.queues[user_id] = deque()
+            self.order.append(user_id)
+        self.queues[user_id].append(job)
+        self._dispatch()
 
-        # Формируем фильтр
-        video_filter = ",".join([f for f in filters if f])
+        try:
+            return await job['future']
+        except asyncio.CancelledError:
+            self._drop(user_id, job)
+            raise
+
+    def _drop(self, user_id: int, job: dict):
+        """Убирает отмененную задачу из очереди или останавливает ее"""
+        if job['task'] is not None:
+            job['task'].cancel()
+            return
+        queue = self.queues.get(user_id)
+        if queue and job in queue:
+            queue.remove(job)
+            if not queue:
+                del self.queues[user_id]
+                self.order.remove(user_id)
+            self._notify_positions()
+
+    def _dispatch(self):
+        while self.order:
+            user_id = self.order[0]
+            queue = self.queues[user_id]
+            # Тяжелая задача ждет свободных слотов, очередь за ней тоже:
+            # иначе легкие задачи не дали бы ей запуститься никогда
+            if self.active + queue[0]['weight'] > self.slots:
+                break
+            self.order.popleft()
+            job = queue.popleft()
+            if queue:
+                self.order.append(user_id)
+            else:
+                del self.queues[user_id]
 
-        # Команда FFmpeg
-        cmd = [
-            FFMPEG, "-y",
-            "-i", str(input_path),
-            "-t", str(STICKER_DURATION),
-            "-an",
-            "-vf", video_filter,
-            "-c:v", "libvpx-vp9",
-            "-b:v", "150k",
-            "-crf", "30",
-            "-deadline", "good",
-            "-pix_fmt", "yuva420p",
-            "-f", "webm",
-            str(output_path)
-        ]
+            self.active += job['weight']
+            job['task'] = asyncio.create_task(self._execute(job))
 
-        # Запускаем
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+            # Сообщаем о старте только тем, кто успел постоять в очереди
+            if job['position'] is not None:
+                self._notify(job, 0)
 
-        stdout, stderr = await proc.communicate()
+        self._notify_positions()
+
+    async def _execute(self, job: dict):
+        try:
+            result = await job['factory']()
+            if not job['future'].done():
+                job['future'].set_result(result)
+        except Exception as e:
+            if not job['future'].done():
+                job['future'].set_exception(e)
+        finally:
+            self.active -= job['weight']
+            self._dispatch()
+
+    def _notify_positions(self):
+        for position, job in enumerate(self.pending_order(), start=1):
+            if job['position'] != position:
+                self._notify(job, position)
+
+    def _notify(self, job: dict, position: int):
+        job['position'] = position
+        if job['on_position'] is None:
+            return
+        task = asyncio.create_task(job['on_position'](position))
+        self._notify_tasks.add(task)
+        task.add_done_callback(self._notify_tasks.discard)
+
+RENDER_SLOTS = int(os.getenv("RENDER_SLOTS", str(os.cpu_count() or 1)))
+render_scheduler = RenderScheduler(RENDER_SLOTS)
+
+# ===== КЭШ РЕНДЕРА =====
+class RenderCache:
+    """Кэш готовых стикеров по хэшу входа и всем параметрам рендера.
+
+    Размер ограничен, при переполнении удаляются давно не использованные
+    записи (LRU). Одинаковые рендеры, запущенные одновременно, склеиваются
+    в один запуск FFmpeg.
+
+    Отдельно (и дольше, чем байты) помним file_id, под которым Telegram
+    сохранил уже отправленный результат: повтор уходит ссылкой, без загрузки.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int, max_sent: int = 10000):
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()
+        self.total_bytes = 0
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self.max_sent = max_sent
+        self.sent: "OrderedDict[str, dict]" = OrderedDict()
+        self.sent_reused = 0
+        self.sent_saved_bytes = 0
+        logger.info(f"🗄 Кэш рендера: до {max_bytes / 1024 / 1024:.0f}MB")
+
+    @staticmethod
+    def make_key(input_hash: str, effect: str, frame: str, text: str,
+                 text_color: str, text_size: str) -> str:
+        encoder = [ENCODER_SETTINGS, ENCODER_PROFILES, STICKER_CRF, STICKER_MAX_KB, SIZE_TARGET_FILL,
+                   STICKER_GEOMETRY]
+        raw = json.dumps([input_hash, effect, frame, text, text_color, text_size, encoder])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if not entry['path'].exists():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, data: bytes, result_text: str, size_kb: int):
+        if len(data) > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+
+        path = self.cache_dir / f"{key}.webm"
+        path.write_bytes(data)
+        self.entries[key] = {
+            'path': path,
+            'bytes': len(data),
+            'result_text': result_text,
+            'size_kb': size_kb
+        }
+        self.total_bytes += len(data)
+
+        while self.total_bytes > self.max_bytes and self.entries:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+
+    def sent_ref(self, key: str) -> Optional[dict]:
+        """Уже отправленный результат: file_id Telegram, подпись и размер"""
+        ref = self.sent.get(key)
+        if ref is not None:
+            self.sent.move_to_end(key)
+        return ref
+
+    def remember_sent(self, key: str, file_id: str, result_text: str, size_kb: int):
+        self.sent[key] = {'file_id': file_id, 'result_text': result_text, 'size_kb': size_kb}
+        self.sent.move_to_end(key)
+        while len(self.sent) > self.max_sent:
+            self.sent.popitem(last=False)
+
+    def forget_sent(self, key: str):
+        self.sent.pop(key, None)
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry['bytes']
+        try:
+            entry['path'].unlink(missing_ok=True)
+        except Exception as e:
+            logger.error(f"Ошибка удаления из кэша: {e}")
+
+    async def get_or_render(self, key: str, render: Callable[[], Awaitable]) -> Tuple[bool, str, int, bytes]:
+        """Отдает результат из кэша, ждет такой же рендер или запускает новый"""
+        async def render_many(names: List[str]) -> Dict[str, Tuple]:
+            return {names[0]: await render()}
+
+        results = await self.get_or_render_many({key: key}, render_many)
+        return results[key]
+
+    async def get_or_render_many(self, keys: Dict[str, str],
+                                 render_many: Callable[[List[str]], Awaitable]) -> Dict[str, Tuple]:
+        """То же для набора результатов {имя: ключ}.
+
+        Недостающие имена рендерятся одним вызовом render_many(names),
+        который возвращает {имя: (success, text, size_kb, data)}.
+        """
+        results = {}
+        waiting = {}
+        missing = []
+        for name, key in keys.items():
+            entry = self.get(key)
+            if entry is not None:
+                self.hits += 1
+                logger.info(f"🗄 Кэш: попадание {key[:12]}")
+                data = await asyncio.to_thread(entry['path'].read_bytes)
+                results[name] = (True, entry['result_text'], entry['size_kb'], data)
+            elif key in self.inflight:
+                self.merged += 1
+                logger.info(f"🗄 Кэш: жду такой же рендер {key[:12]}")
+                waiting[name] = self.inflight[key]
+            else:
+                self.misses += 1
+                missing.append(name)
 
-        if proc.returncode == 0 and output_path.exists():
-            size_kb = output_path.stat().st_size / 1024
+        futures = {}
+        for name in missing:
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.inflight[keys[name]] = future
+            futures[name] = future
 
-            # Формируем результат
-            result_msg = f"✅ <b>Стикер создан!</b>\n\n"
+        try:
+            if missing:
+                rendered = await render_many(missing)
+                for name in missing:
+                    result = rendered.get(name, (False, "❌ Ошибка FFmpeg", 0, b''))
+                    if result[0]:
+                        self.put(keys[name], result[3], result[1], result[2])
+                    futures[name].set_result(result)
+                    results[name] = result
+        except asyncio.CancelledError:
+            for future in futures.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        finally:
+            for name, future in futures.items():
+                if self.inflight.get(keys[name]) is future:
+                    del self.inflight[keys[name]]
+
+        retry = {}
+        for name, pending in waiting.items():
+            try:
+                results[name] = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # Исходный рендер отменен - запускаем свой
+                retry[name] = keys[name]
+        if retry:
+            results.update(await self.get_or_render_many(retry, render_many))
+
+        return {name: results[name] for name in keys}
+
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_MB", "200")) * 1024 * 1024
+SENT_REFS_MAX = int(os.getenv("SENT_REFS_MAX", "10000"))
+render_cache = RenderCache(storage.storage_dir / "_cache", RENDER_CACHE_MAX_BYTES, SENT_REFS_MAX)
+
+# ===== ДОПУСК НОВЫХ ВИДЕО =====
+MAX_ACTIVE_DOWNLOADS = int(os.getenv("MAX_ACTIVE_DOWNLOADS", "4"))
+MAX_QUEUED_DOWNLOADS = int(os.getenv("MAX_QUEUED_DOWNLOADS", "20"))
+# Рендеров (идущих и ждущих) на слот, после которых новые видео не принимаются
+MAX_RENDER_BACKLOG = float(os.getenv("MAX_RENDER_BACKLOG", "8"))
+MIN_FREE_DISK_MB = int(os.getenv("MIN_FREE_DISK_MB", "500"))
+# Load average за минуту на ядро; 0 - не проверять
+MAX_LOAD_PER_CPU = float(os.getenv("MAX_LOAD_PER_CPU", "4"))
+
+class AdmissionControl:
+    """Допуск новых видео: отказ при перегрузке и очередь на скачивание.
+
+    Видео не принимается, если очередь рендера слишком длинная, на диске
+    мало места или высокая загрузка системы - такие задачи все равно не
+    успеют. Скачиваний одновременно не больше max_active, остальные ждут
+    в FIFO (до max_queued) и видят свое место в очереди.
+    """
+
+    def __init__(self, max_active: int, max_queued: int):
+        self.max_active = max(1, max_active)
+        self.max_queued = max_queued
+        self.active = 0
+        self.waiting: deque = deque()
+        self._notify_tasks = set()
+
+    def overload_reason(self) -> Optional[str]:
+        """Причина отказа или None, если видео можно принять"""
+        backlog = render_scheduler.active + render_scheduler.queued
+        if backlog >= MAX_RENDER_BACKLOG * render_scheduler.slots:
+            return "render"
+        if shutil.disk_usage(storage.storage_dir).free < MIN_FREE_DISK_MB * 1024 * 1024:
+            return "disk"
+        if MAX_LOAD_PER_CPU and hasattr(os, "getloadavg"):
+            if os.getloadavg()[0] / (os.cpu_count() or 1) > MAX_LOAD_PER_CPU:
+                return "load"
+        if self.busy and len(self.waiting) >= self.max_queued:
+            return "downloads"
+        return None
 
-            # Эффект
-            effect_name = VIDEO_EFFECTS.get(effect, {}).get("name", effect)
-            effect_desc = VIDEO_EFFECTS.get(effect, {}).get("description", "")
-            result_msg += f"🎬 <b>Эффект:</b> {effect_name}\n"
-            result_msg += f"📝 <i>{effect_desc}</i>\n"
+    @property
+    def busy(self) -> bool:
+        """Новое скачивание встанет в очередь"""
+        return self.active >= self.max_active or bool(self.waiting)
 
-            # Рамка
-            frame_name = FRAMES.get(frame, {}).get("name", frame)
-            result_msg += f"🖼️ <b>Рамка:</b> {frame_name}\n"
+    async def acquire(self, on_position=None):
+        """Ждет слот скачивания; on_position(N) - место в очереди"""
+        if not self.busy:
+            self.active += 1
+            return
 
-            if text:
-                result_msg += f"📝 <b>Текст:</b> {text[:20]}{'...' if len(text) > 20 else ''}\n"
-                result_msg += f"🎨 <b>Цвет:</b> {TEXT_COLORS.get(text_color, 'Белый')}\n"
-                result_msg += f"📏 <b>Размер:</b> {TEXT_SIZES.get(text_size, 'Средний')}\n"
+        waiter = {
+            'future': asyncio.get_running_loop().create_future(),
+            'on_position': on_position,
+            'position': None
+        }
+        self.waiting.append(waiter)
+        metrics.inc("sticker_admission_deferred_total")
+        self._notify_positions()
+        try:
+            await waiter['future']
+        except asyncio.CancelledError:
+            if waiter in self.waiting:
+                self.waiting.remove(waiter)
+                self._notify_positions()
+            elif not waiter['future'].cancelled():
+                # Слот уже передан нам - отдаем следующему
+                self.release()
+            raise
+
+    def release(self):
+        """Освобождает слот: он сразу переходит первому в очереди"""
+        while self.waiting:
+            waiter = self.waiting.popleft()
+            if not waiter['future'].done():
+                waiter['future'].set_result(None)
+                self._notify_positions()
+                return
+        self.active -= 1
+
+    def _notify_positions(self):
+        for position, waiter in enumerate(self.waiting, start=1):
+            if waiter['position'] == position:
+                continue
+            waiter['position'] = position
+            if waiter['on_position'] is None:
+                continue
+            task = asyncio.create_task(waiter['on_position'](position))
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+admission = AdmissionControl(MAX_ACTIVE_DOWNLOADS, MAX_QUEUED_DOWNLOADS)
+
+# ===== ОГРАНИЧЕНИЕ ЧАСТОТЫ =====
+def parse_rate(value: str) -> Tuple[int, float]:
+    """"10/600" -> не больше 10 событий подряд, 10 за 600 секунд"""
+    count, seconds = value.split("/")
+    return max(1, int(count)), float(seconds)
+
+RATE_LIMITS = {
+    "uploads": parse_rate(os.getenv("RATE_LIMIT_UPLOADS", "10/600")),
+    "renders": parse_rate(os.getenv("RATE_LIMIT_RENDERS", "20/600")),
+    "messages": parse_rate(os.getenv("RATE_LIMIT_MESSAGES", "30/60"))
+}
 
-            result_msg += f"📦 <b>Размер файла:</b> {size_kb:.1f}KB / 256KB\n"
-            result_msg += f"📐 <b>Разрешение:</b> 512x512\n"
-            result_msg += f"⏱ <b>Длительность:</b> {STICKER_DURATION}с\n"
+class RateLimiter(BaseMiddleware):
+    """Token bucket на пользователя отдельно для загрузок, рендеров и сообщений.
+
+    Ведро хранится одним числом (GCRA): время, когда оно снова будет полным.
+    Полные ведра ничем не отличаются от отсутствующих, поэтому sweep()
+    их удаляет и в памяти остаются только недавно активные пользователи.
+    """
+
+    def __init__(self, budgets: Dict[str, Tuple[int, float]]):
+        self.budgets = budgets
+        self.full_at: Dict[str, Dict[int, float]] = {name: {} for name in budgets}
+
+    def hit(self, budget: str, user_id: int, now: Optional[float] = None) -> float:
+        """Тратит токен: 0 - можно, иначе через сколько секунд появится токен"""
+        burst, period = self.budgets[budget]
+        interval = period / burst
+        now = time.monotonic() if now is None else now
+        table = self.full_at[budget]
+        full_at = max(table.get(user_id, now), now)
+        wait = full_at - now - (burst - 1) * interval
+        if wait > 0:
+            return wait
+        table[user_id] = full_at + interval
+        return 0.0
+
+    def sweep(self) -> int:
+        """Удаляет полные ведра, возвращает, сколько осталось"""
+        now = time.monotonic()
+        for budget, table in self.full_at.items():
+            self.full_at[budget] = {uid: t for uid, t in table.items() if t > now}
+        return self.tracked
+
+    @property
+    def tracked(self) -> int:
+        return sum(len(table) for table in self.full_at.values())
+
+    @staticmethod
+    def classify(event: TelegramObject) -> str:
+        if isinstance(event, CallbackQuery):
+            # Рамка - последний шаг мастера, нажатие запускает рендер
+            return "renders" if (event.data or "").startswith("frame_") else "messages"
+        if isinstance(event, Message) and (event.video or event.animation or event.document):
+            return "uploads"
+        return "messages"
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is None:
+            return await handler(event, data)
+
+        budget = self.classify(event)
+        wait = self.hit(budget, user.id)
+        if not wait:
+            return await handler(event, data)
+
+        metrics.inc("sticker_rate_limited_total", budget=budget)
+        logger.warning(f"🚧 {user.id}: лимит {budget}, ждать {wait:.0f}с")
+        # На лишние сообщения не отвечаем, чтобы флуд не удваивал трафик
+        text = f"⏳ Слишком часто! Попробуй через {int(wait) + 1}с"
+        if isinstance(event, CallbackQuery):
+            await event.answer(text, show_alert=budget == "renders")
+        elif budget == "uploads":
+            await event.answer(text)
+        return None
 
-            if size_kb <= 256:
-                result_msg += f"\n🎉 <b>Соответствует требованиям Telegram!</b>"
-            else:
-                result_msg += f"\n⚠️ <b>Слишком большой, но можно попробовать отправить</b>"
+rate_limiter = RateLimiter(RATE_LIMITS)
+dp.message.outer_middleware(rate_limiter)
+dp.callback_query.outer_middleware(rate_limiter)
+
+# ===== ПРЕВЬЮ ЭФФЕКТОВ =====
+PREVIEW_CELL = 160  # Размер одной ячейки превью
+PREVIEW_COLUMNS = 4
+PREVIEW_TIME = 0.5  # С какой секунды брать кадр
+# Сколько ждать превью после выбора размера, дальше - только кнопки
+PREVIEW_WAIT = float(os.getenv("PREVIEW_WAIT_SECONDS", "2"))
+
+async def create_effects_preview(input_path: Path, normalized: bool = False,
+                                 media: Optional[dict] = None) -> Optional[bytes]:
+    """Один кадр под каждым эффектом, собранный в сетку (JPEG).
+
+    Делается одним запуском FFmpeg в низком разрешении: кадр масштабируется,
+    split раздает его по эффектам, xstack собирает сетку.
+    """
+    effects = list(VIDEO_EFFECTS)
+    base_filter = "".join(f"{f}," for f in ([] if normalized else base_filters(media)))
+    labels = "".join(f"[s{i}]" for i in range(len(effects)))
+    # Кадр может быть неквадратным - вписываем в ячейку с полями
+    cell = (f"scale={PREVIEW_CELL}:{PREVIEW_CELL}:force_original_aspect_ratio=decrease,"
+            f"pad={PREVIEW_CELL}:{PREVIEW_CELL}:(ow-iw)/2:(oh-ih)/2")
+    graph = [f"[0:v]{base_filter}{cell},split={len(effects)}{labels}"]
+
+    layout = []
+    for i, effect in enumerate(effects):
+        effect_filter = VIDEO_EFFECTS[effect]["filter"]
+        chain = f"{effect_filter}," if effect_filter else ""
+        graph.append(f"[s{i}]{chain}format=yuv420p[p{i}]")
+        row, col = divmod(i, PREVIEW_COLUMNS)
+        layout.append(f"{col * PREVIEW_CELL}_{row * PREVIEW_CELL}")
+
+    inputs = "".join(f"[p{i}]" for i in range(len(effects)))
+    # fill есть только в FFmpeg 4.3+ и нужен, лишь когда в сетке есть пустые ячейки
+    fill = ":fill=black" if len(effects) % PREVIEW_COLUMNS else ""
+    graph.append(f"{inputs}xstack=inputs={len(effects)}:layout={'|'.join(layout)}{fill}")
+
+    # Если ролик короче PREVIEW_TIME, берем самый первый кадр
+    for seek in (PREVIEW_TIME, 0):
+        cmd = [
+            FFMPEG, "-y",
+            "-ss", str(seek),
+            *([] if normalized else decode_args(media)),
+            "-i", str(input_path),
+            "-filter_complex", ";".join(graph),
+            "-frames:v", "1",
+            "-c:v", "mjpeg",
+            "-q:v", "5",
+            "-f", "image2pipe",
+            "pipe:1"
+        ]
+        try:
+            async with normalize_semaphore:
+                returncode, data, stderr = await run_ffmpeg(cmd)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка превью: {e}")
+            return None
+        if returncode == 0 and data:
+            logger.info(f"🖼 Превью эффектов: {len(data) / 1024:.1f}KB")
+            return data
+
+    logger.error(f"Ошибка превью: {stderr.decode('utf-8', errors='ignore')[-300:]}")
+    return None
+
+def effects_preview_caption() -> str:
+    """Подпись к превью: номера ячеек слева направо, сверху вниз"""
+    lines = [f"{i}. {data['name']}" for i, data in enumerate(VIDEO_EFFECTS.values(), start=1)]
+    return "👀 <b>Превью эффектов:</b>\n\n" + "\n".join(lines)
+
+# ===== ФОНОВАЯ ОЧИСТКА =====
+async def storage_sweeper():
+    """Периодически чистит хранилище и пишет, сколько занято"""
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            stats = storage.sweep()
+            rate_limiter.sweep()
+            logger.info(
+                f"📊 Хранилище: файлов {stats['files']}, {stats['bytes'] / 1024 / 1024:.1f}MB, "
+                f"сессий {stats['user_data']}; кэш рендера: {len(render_cache.entries)} шт., "
+                f"{render_cache.total_bytes / 1024 / 1024:.1f}MB; кэш загрузок: "
+                f"{len(upload_cache.entries)} шт., попаданий {upload_cache.hits}/"
+                f"{upload_cache.hits + upload_cache.misses}, сэкономлено "
+                f"{upload_cache.bytes_saved / 1024 / 1024:.1f}MB"
+            )
+        except Exception as e:
+            logger.error(f"Ошибка очистки хранилища: {e}")
+
+# ===== ПРЕДВАРИТЕЛЬНЫЙ РЕНДЕР =====
+SPECULATIVE_RENDER = os.getenv("SPECULATIVE_RENDER", "1") == "1"
+frame_picks: Dict[str, int] = {}  # Сколько раз выбирали каждую рамку
+
+async def render_sticker(user_id: int, file_id: str, effect: str, frame: str, text: str,
+                         text_color: str, text_size: str, on_position=None) -> Tuple[bool, str, int, bytes]:
+    """Рендер одного стикера через общую очередь, результат - байты WebM"""
+    render_path, normalized = await storage.render_input(file_id, effect_input_span(effect))
+    if render_path is None:
+        return False, "❌ Файл не найден. Отправь видео заново.", 0, b''
+
+    return await render_scheduler.run(
+        user_id,
+        lambda: create_sticker_simple(
+            render_path, None, effect, frame, text, text_color, text_size,
+            normalized=normalized, media=storage.media(file_id)
+        ),
+        on_position=on_position
+    )
 
-            return True, result_msg, int(size_kb)
-        else:
-            error = stderr.decode('utf-8', errors='ignore')[:300]
-            logger.error(f"FFmpeg ошибка: {error}")
-            return False, f"❌ Ошибка FFmpeg", 0
+def cancel_speculative_render(user_id: int) -> Optional[dict]:
+    """Снимает предварительный рендер пользователя; возвращает его описание"""
+    session = storage.user_data.get(user_id)
+    speculative = session.pop('speculative', None) if session else None
+    if speculative is not None and not speculative['task'].done():
+        speculative['task'].cancel()
+    return speculative
+
+def start_speculative_render(user_id: int):
+    """Пока пользователь выбирает рамку, рендерим самую популярную.
+
+    Только если рендер простаивает: чужим задачам это не мешает. Результат
+    ложится в render_cache, поэтому нажатие на ту же рамку склеивается с
+    идущим рендером или сразу берет готовый. Другая рамка, новое видео или
+    брошенная сессия отменяют задачу (вместе с процессом FFmpeg).
+    """
+    session = storage.user_data.get(user_id)
+    if not SPECULATIVE_RENDER or session is None or session.get('effect') == MULTI_EFFECT:
+        return
+    cancel_speculative_render(user_id)
+    if render_scheduler.queued or render_scheduler.active >= render_scheduler.slots:
+        return
+
+    file_id = session['file_id']
+    info = storage.files.get(file_id)
+    if info is None:
+        return
+    effect = session['effect']
+    frame = max(frame_picks, key=frame_picks.get) if frame_picks else "none"
+    text = session.get('text', '')
+    text_color = session.get('text_color', 'white')
+    text_size = session.get('text_size', 'medium')
+
+    async def speculate():
+        try:
+            input_hash = await storage.content_hash(file_id)
+            key = render_cache.make_key(input_hash, effect, frame, text, text_color, text_size)
+            if render_cache.sent_ref(key) is not None:
+                return
+            await render_cache.get_or_render(
+                key,
+                lambda: render_sticker(user_id, file_id, effect, frame, text, text_color, text_size)
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"Предварительный рендер не удался: {e}")
 
-    except Exception as e:
-        logger.error(f"🔥 Ошибка в create_sticker_simple: {e}")
-        return False, f"❌ Ошибка: {str(e)[:100]}", 0
+    task = asyncio.create_task(speculate())
+    info['speculative_task'] = task
+    session['speculative'] = {'effect': effect, 'frame': frame, 'task': task}
+    metrics.inc("sticker_speculative_total", outcome="started")
+    logger.info(f"🔮 Предварительный рендер для {user_id}: {effect}/{frame}")
 
 # ===== ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ ДЛЯ ПАРСИНГА =====
 def parse_simple_callback(data: str, prefix: str) -> Tuple[str, int]:
@@ -469,8 +2518,8 @@ async def start_command(message: Message):
     await message.answer(
         "🎬 <b>Video Sticker Bot 2.9s</b>\n\n"
         "✅ <b>Создаю стикеры для Telegram:</b>\n"
-        "• 512x512 пикселей\n"
-        "• 2.9 секунды\n"
+        + ("• 512px по длинной стороне\n" if STICKER_GEOMETRY == "fit" else "• 512x512 пикселей\n") +
+        "• До 2.9 секунды\n"
         "• WebM формат\n"
         "• До 256KB\n\n"
         "✨ <b>Функции:</b>\n"
@@ -563,74 +2612,152 @@ async def handle_video(message: Message):
 
         # Определяем тип файла
         if message.video:
-            file_id = message.video.file_id
-            file_size = message.video.file_size or 0
+            media = message.video
             ext = ".mp4"
         elif message.animation:
-            file_id = message.animation.file_id
-            file_size = message.animation.file_size or 0
+            media = message.animation
             ext = ".gif"
         else:
-            file_id = message.document.file_id
-            file_size = message.document.file_size or 0
+            media = message.document
             ext = ".mp4"
+        file_id = media.file_id
+        file_size = media.file_size or 0
 
         # Проверка размера
         if file_size > MAX_FILE_SIZE:
             await message.answer(f"❌ <b>Файл слишком большой!</b>\nМаксимум: {MAX_FILE_SIZE/1024/1024:.0f}MB")
             return
 
-        status_msg = await message.answer("📥 <i>Скачиваю файл...</i>", parse_mode=ParseMode.HTML)
+        # Перегрузка: сразу отказываем, чем принять задачу, которая не успеет
+        reason = admission.overload_reason()
+        if reason:
+            metrics.inc("sticker_admission_rejected_total", reason=reason)
+            logger.warning(f"🚦 Видео от {user_id} не принято: {reason}")
+            backlog = render_scheduler.active + render_scheduler.queued
+            await message.answer(
+                "😓 <b>Бот сейчас перегружен</b>\n\n"
+                + (f"В очереди {backlog} стикеров. " if reason == "render" else "")
+                + "Попробуй отправить видео через пару минут.",
+                parse_mode=ParseMode.HTML
+            )
+            return
+
+        # Этот файл уже скачивали (тот же file_unique_id) - берем из кэша
+        cached = upload_cache.get(media.file_unique_id)
+        if cached is not None:
+            saved_id, input_path = storage.allocate(user_id, cached['path'].suffix)
+            link_or_copy(cached['path'], input_path)
+            storage.add(saved_id, user_id, input_path, content_hash=cached['hash'],
+                        media=cached['media'])
+            storage.start_normalize(saved_id, prepared=cached['normalized_path'])
+            logger.info(f"♻️ Файл из кэша загрузок: {cached['source_size']/1024:.1f}KB")
+            status_msg = await message.answer("📥 <i>Файл уже есть, скачивать не нужно</i>",
+                                              parse_mode=ParseMode.HTML)
+            await start_text_step(user_id, saved_id, status_msg)
+            return
+
+        # Пока видео ждет и скачивается, второе от того же пользователя не берем
+        storage.user_data[user_id]['step'] = 'downloading'
+        # Скачиваем файл сразу в хранилище, хэш считаем по ходу загрузки
+        saved_id, input_path = storage.allocate(user_id, ext)
+        registered = False
+        try:
+            deferred = admission.busy
+            status_msg = await message.answer(
+                "⏳ <i>Бот занят, видео в очереди на загрузку...</i>" if deferred
+                else "📥 <i>Скачиваю файл...</i>",
+                parse_mode=ParseMode.HTML
+            )
+
+            async def report_position(position: int):
+                """Показывает место в очереди на скачивание"""
+                try:
+                    await status_msg.edit_text(
+                        f"⏳ <i>Бот занят, ты #{position} в очереди на загрузку</i>",
+                        parse_mode=ParseMode.HTML
+                    )
+                except Exception as e:
+                    logger.debug(f"Не удалось обновить позицию в очереди: {e}")
 
-        # Скачиваем файл
-        with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
-            input_path = Path(tmp.name)
+            await admission.acquire(report_position)
             try:
+                if deferred:
+                    await status_msg.edit_text("📥 <i>Скачиваю файл...</i>", parse_mode=ParseMode.HTML)
+                download_start = time.monotonic()
                 file = await bot.get_file(file_id)
-                await bot.download_file(file.file_path, str(input_path))
-                logger.info(f"✅ Файл скачан: {input_path.stat().st_size/1024:.1f}KB")
+                with open(input_path, 'wb') as f:
+                    writer = HashingWriter(f)
+                    await bot.download_file(file.file_path, writer, seek=False)
+                metrics.observe("sticker_download_seconds", time.monotonic() - download_start)
+                logger.info(f"✅ Файл скачан: {writer.size/1024:.1f}KB")
             except Exception as e:
                 await status_msg.edit_text(f"❌ <b>Ошибка скачивания:</b> {e}")
                 return
+            finally:
+                admission.release()
+
+            if writer.size == 0:
+                await status_msg.edit_text("❌ <b>Файл пустой или поврежден</b>")
+                return
 
-        if not input_path.exists() or input_path.stat().st_size == 0:
-            await status_msg.edit_text("❌ <b>Файл пустой или поврежден</b>")
+            # Проба заголовка: негодный файл отклоняем до всякого рендера
             try:
-                input_path.unlink()
-            except:
-                pass
-            return
+                probe = await probe_media(input_path)
+                problem = media_problem(probe)
+            except asyncio.TimeoutError:
+                probe, problem = None, "timeout"
+            if problem:
+                metrics.inc("sticker_probe_rejected_total", reason=problem)
+                logger.warning(f"🔍 Видео от {user_id} отклонено: {problem}")
+                await status_msg.edit_text(
+                    f"❌ <b>Не получится сделать стикер:</b> {PROBE_REJECT_MESSAGES[problem]}\n\n"
+                    "Отправь другое видео."
+                )
+                return
 
-        # Сохраняем в хранилище
-        saved_id = storage.save(user_id, input_path)
-
-        # Сохраняем данные пользователя
-        storage.user_data[user_id] = {
-            'file_id': saved_id,
-            'step': 'waiting_text',
-            'text': '',
-            'effect': 'none',
-            'frame': 'none',
-            'text_color': 'white',
-            'text_size': 'medium'
-        }
+            # Регистрируем в хранилище и в кэше загрузок
+            storage.add(saved_id, user_id, input_path, content_hash=writer.hexdigest(), media=probe)
+            registered = True
+        finally:
+            # Любой выход до регистрации (ошибка, отказ, отмена): файл без записи
+            # в хранилище никто не удалит, а шаг 'downloading' не пустит новое видео
+            if not registered:
+                input_path.unlink(missing_ok=True)
+                session = storage.user_data.get(user_id)
+                if session is not None and session.get('step') == 'downloading':
+                    session['step'] = 'waiting_video'
 
-        await status_msg.edit_text(
-            "✅ <b>Видео получено!</b>\n\n"
-            "📝 <b>Хочешь добавить текст на видео?</b>\n\n"
-            "Отправь текст (до 25 символов) или нажми /skip",
-            parse_mode=ParseMode.HTML
-        )
+        normalize_task = storage.start_normalize(saved_id)
+        upload_cache.put(media.file_unique_id, input_path, writer.hexdigest(), probe)
+        upload_cache.watch_normalize(media.file_unique_id, normalize_task)
 
-        try:
-            input_path.unlink()
-        except:
-            pass
+        await start_text_step(user_id, saved_id, status_msg)
 
     except Exception as e:
         logger.error(f"❌ Ошибка в handle_video: {e}")
         await message.answer(f"❌ <b>Ошибка:</b> {str(e)[:200]}", parse_mode=ParseMode.HTML)
 
+async def start_text_step(user_id: int, saved_id: str, status_msg: Message):
+    """Видео принято - сохраняем сессию и спрашиваем про текст"""
+    # Пока пользователь пишет текст, превью эффектов строится в фоне
+    storage.start_preview(saved_id)
+    storage.user_data[user_id] = {
+        'file_id': saved_id,
+        'step': 'waiting_text',
+        'text': '',
+        'effect': 'none',
+        'frame': 'none',
+        'text_color': 'white',
+        'text_size': 'medium'
+    }
+
+    await status_msg.edit_text(
+        "✅ <b>Видео получено!</b>\n\n"
+        "📝 <b>Хочешь добавить текст на видео?</b>\n\n"
+        "Отправь текст (до 25 символов) или нажми /skip",
+        parse_mode=ParseMode.HTML
+    )
+
 @router.message(F.text & ~F.text.startswith("/"))
 async def handle_text(message: Message):
     """Обработка текста для видео"""
@@ -797,6 +2924,32 @@ async def handle_size(callback: CallbackQuery):
         if row:
             keyboard.inline_keyboard.append(row)
 
+        # Все эффекты одним проходом
+        keyboard.inline_keyboard.append([InlineKeyboardButton(
+            text=MULTI_EFFECT_DATA['name'],
+            callback_data=f"effect_{MULTI_EFFECT}_{user_id}"
+        )])
+
+        # Превью эффектов на кадре пользователя
+        preview = await storage.effects_preview(storage.user_data[user_id].get('file_id'), PREVIEW_WAIT)
+        if preview:
+            await callback.message.edit_text(
+                f"✅ <b>Размер выбран:</b> {TEXT_SIZES[size]}",
+                parse_mode=ParseMode.HTML
+            )
+            await callback.message.answer_photo(
+                BufferedInputFile(preview, filename="effects.jpg"),
+                caption=effects_preview_caption(),
+                parse_mode=ParseMode.HTML
+            )
+            await callback.message.answer(
+                f"🎬 <b>Теперь выбери видео эффект:</b>\n\n"
+                f"<i>Каждый эффект ЗАМЕТНО меняет видео!</i>",
+                reply_markup=keyboard,
+                parse_mode=ParseMode.HTML
+            )
+            return
+
         await callback.message.edit_text(
             f"✅ <b>Размер выбран:</b> {TEXT_SIZES[size]}\n\n"
             f"🎬 <b>Теперь выбери видео эффект:</b>\n\n"
@@ -817,7 +2970,7 @@ async def handle_effect(callback: CallbackQuery):
         effect, user_id = parse_simple_callback(callback.data, "effect_")
 
         # Проверяем существует ли эффект
-        if effect not in VIDEO_EFFECTS:
+        if effect not in VIDEO_EFFECTS and effect != MULTI_EFFECT:
             logger.error(f"❌ Неизвестный эффект: {effect}")
             await callback.answer(f"❌ Неизвестный эффект", show_alert=True)
             return
@@ -827,7 +2980,7 @@ async def handle_effect(callback: CallbackQuery):
             return
 
         # Получаем данные эффекта
-        effect_data = VIDEO_EFFECTS[effect]
+        effect_data = VIDEO_EFFECTS.get(effect, MULTI_EFFECT_DATA)
 
         # Сохраняем эффект
         storage.user_data[user_id]['effect'] = effect
@@ -855,6 +3008,9 @@ async def handle_effect(callback: CallbackQuery):
             parse_mode=ParseMode.HTML
         )
 
+        # Все, кроме рамки, уже известно - начинаем рендер заранее
+        start_speculative_render(user_id)
+
     except Exception as e:
         logger.error(f"❌ Ошибка в handle_effect: {e}")
 
@@ -879,6 +3035,18 @@ async def handle_frame(callback: CallbackQuery):
         text_color = storage.user_data[user_id].get('text_color', 'white')
         text_size = storage.user_data[user_id].get('text_size', 'medium')
 
+        # Предварительный рендер: та же рамка - он продолжится и станет результатом
+        frame_picks[frame] = frame_picks.get(frame, 0) + 1
+        session = storage.user_data[user_id]
+        speculative = session.get('speculative')
+        if speculative is not None:
+            if speculative['effect'] == effect and speculative['frame'] == frame:
+                session.pop('speculative')
+                metrics.inc("sticker_speculative_total", outcome="hit")
+            else:
+                cancel_speculative_render(user_id)
+                metrics.inc("sticker_speculative_total", outcome="miss")
+
         # Получаем файл
         input_path = storage.get(file_id)
         if input_path is None or not input_path.exists():
@@ -886,7 +3054,7 @@ async def handle_frame(callback: CallbackQuery):
             return
 
         # Получаем имена
-        effect_data = VIDEO_EFFECTS.get(effect, {})
+        effect_data = MULTI_EFFECT_DATA if effect == MULTI_EFFECT else VIDEO_EFFECTS.get(effect, {})
         effect_name = effect_data.get('name', effect)
         effect_desc = effect_data.get('description', '')
 
@@ -894,7 +3062,7 @@ async def handle_frame(callback: CallbackQuery):
 
         await bot.send_chat_action(callback.message.chat.id, ChatAction.UPLOAD_VIDEO)
 
-        processing_msg = await callback.message.answer(
+        status_text = (
             f"🎬 <b>Создаю стикер...</b>\n\n"
             f"✨ <i>Эффект:</i> {effect_name}\n"
             f"📝 <i>{effect_desc}</i>\n"
@@ -902,41 +3070,143 @@ async def handle_frame(callback: CallbackQuery):
             f"📝 <i>Текст:</i> {text[:15] if text else 'нет'}\n"
             f"🎨 <i>Цвет:</i> {TEXT_COLORS.get(text_color, 'Белый')}\n"
             f"📏 <i>Размер:</i> {TEXT_SIZES.get(text_size, 'Средний')}\n\n"
-            f"⏳ <i>Обработка...</i>",
+        )
+
+        processing_msg = await callback.message.answer(
+            status_text + "⏳ <i>Обработка...</i>",
             parse_mode=ParseMode.HTML
         )
 
-        # Создаем временный файл для результата
-        with tempfile.NamedTemporaryFile(suffix=".webm", delete=False) as tmp:
-            output_path = Path(tmp.name)
+        async def report_position(position: int):
+            """Показывает пользователю его место в очереди рендера"""
+            try:
+                if position > 0:
+                    await processing_msg.edit_text(
+                        status_text + f"⏳ <i>В очереди: #{position}</i>",
+                        parse_mode=ParseMode.HTML
+                    )
+                else:
+                    await processing_msg.edit_text(
+                        status_text + "⏳ <i>Обработка...</i>",
+                        parse_mode=ParseMode.HTML
+                    )
+            except Exception as e:
+                logger.debug(f"Не удалось обновить позицию в очереди: {e}")
+
+        async def render_many(effects: List[str]) -> Dict[str, Tuple]:
+            """Несколько эффектов одним процессом FFmpeg через общую очередь"""
+            render_path, normalized = await storage.render_input(
+                file_id, max(effect_input_span(e) for e in effects)
+            )
+            if render_path is None:
+                return {e: (False, "❌ Файл не найден. Отправь видео заново.", 0, b'') for e in effects}
+
+            return await render_scheduler.run(
+                user_id,
+                lambda: create_stickers_multi(
+                    render_path, effects, frame, text, text_color, text_size,
+                    normalized=normalized, media=storage.media(file_id)
+                ),
+                on_position=report_position,
+                weight=len(effects)
+            )
 
-        # Создаем стикер
-        success, result_text, size_kb = await create_sticker_simple(
-            input_path, output_path, effect, frame, text, text_color, text_size
-        )
+        async def render():
+            """Рендер через общую очередь, результат - байты WebM"""
+            return await render_sticker(user_id, file_id, effect, frame, text, text_color, text_size,
+                                        on_position=report_position)
+
+        async def render_results(keys: Dict[str, str]) -> Dict[str, Tuple]:
+            """Результаты из кэша или новым рендером"""
+            if effect == MULTI_EFFECT:
+                return await render_cache.get_or_render_many(keys, render_many)
+            return {name: await render_cache.get_or_render(key, render) for name, key in keys.items()}
+
+        # Создаем стикер(ы) (или берем готовые из кэша)
+        input_hash = await storage.content_hash(file_id)
+        effects = list(VIDEO_EFFECTS) if effect == MULTI_EFFECT else [effect]
+        cache_keys = {
+            e: render_cache.make_key(input_hash, e, frame, text, text_color, text_size)
+            for e in effects
+        }
 
-        if success:
+        # Уже отправленные результаты не рендерим и не загружаем - хватит file_id
+        sent_refs = {e: render_cache.sent_ref(key) for e, key in cache_keys.items()}
+        to_render = {e: key for e, key in cache_keys.items() if sent_refs[e] is None}
+        results = await render_results(to_render) if to_render else {}
+        for e, ref in sent_refs.items():
+            if ref is not None:
+                results[e] = (True, ref['result_text'], ref['size_kb'], b'')
+        results = {e: results[e] for e in effects}
+
+        done_results = {e: r for e, r in results.items() if r[0]}
+        if done_results:
             await processing_msg.edit_text("📤 <i>Отправляю файл...</i>", parse_mode=ParseMode.HTML)
 
             try:
-                # Читаем файл
-                with open(output_path, 'rb') as f:
-                    webm_data = f.read()
-
-                # Генерируем имя файла
-                timestamp = int(time.time())
-                filename = f"sticker_{timestamp}.webm"
-
-                # Отправляем файл
-                await bot.send_document(
-                    callback.message.chat.id,
-                    document=BufferedInputFile(webm_data, filename=filename),
-                    caption=result_text,
-                    parse_mode=ParseMode.HTML
-                )
+                for result_effect, (success, result_text, size_kb, webm_data) in done_results.items():
+                    # Генерируем имя файла
+                    timestamp = int(time.time())
+                    if effect == MULTI_EFFECT:
+                        filename = f"sticker_{timestamp}_{result_effect}.webm"
+                    else:
+                        filename = f"sticker_{timestamp}.webm"
+
+                    # Отправляем файл: ссылкой, если он уже есть у Telegram
+                    cache_key = cache_keys[result_effect]
+                    ref = sent_refs[result_effect]
+                    upload_start = time.monotonic()
+                    sent = None
+                    via = "upload"
+                    if ref is not None:
+                        try:
+                            sent = await bot.send_document(
+                                callback.message.chat.id,
+                                document=ref['file_id'],
+                                caption=result_text,
+                                parse_mode=ParseMode.HTML
+                            )
+                            via = "file_id"
+                            render_cache.sent_reused += 1
+                            render_cache.sent_saved_bytes += size_kb * 1024
+                        except TelegramBadRequest as e:
+                            # file_id больше не принимается - забываем и загружаем байты
+                            logger.warning(f"📎 file_id не подошел: {e}")
+                            render_cache.forget_sent(cache_key)
+                            success, result_text, size_kb, webm_data = (
+                                await render_results({result_effect: cache_key})
+                            )[result_effect]
+                            if not success:
+                                await callback.message.answer(result_text, parse_mode=ParseMode.HTML)
+                                continue
+
+                    if sent is None:
+                        sent = await bot.send_document(
+                            callback.message.chat.id,
+                            document=BufferedInputFile(webm_data, filename=filename),
+                            caption=result_text,
+                            parse_mode=ParseMode.HTML
+                        )
+                        if sent.document is not None:
+                            render_cache.remember_sent(cache_key, sent.document.file_id, result_text, size_kb)
+
+                    metrics.observe(
+                        "sticker_upload_seconds", time.monotonic() - upload_start,
+                        effect=result_effect, frame=frame, via=via
+                    )
+
+                # Часть эффектов за проход не получилась - говорим, какие
+                failed = [e for e in effects if e not in done_results]
+                if failed:
+                    names = ", ".join(VIDEO_EFFECTS[e]['name'] for e in failed)
+                    await callback.message.answer(
+                        f"⚠️ <b>Не получились эффекты ({len(failed)} из {len(effects)}):</b> {names}\n\n"
+                        "<i>Их можно выбрать по одному - отправь видео заново.</i>",
+                        parse_mode=ParseMode.HTML
+                    )
 
                 # Инструкция
-                if size_kb <= 256:
+                if any(r[2] <= STICKER_MAX_KB for r in done_results.values()):
                     await callback.message.answer(
                         "💡 <b>Как добавить стикер:</b>\n\n"
                         "1. Сохрани файл\n"
@@ -950,12 +3220,11 @@ async def handle_frame(callback: CallbackQuery):
             except Exception as e:
                 await processing_msg.edit_text(f"❌ <b>Ошибка отправки:</b> {str(e)[:200]}", parse_mode=ParseMode.HTML)
         else:
+            result_text = next(iter(results.values()))[1]
             await processing_msg.edit_text(result_text, parse_mode=ParseMode.HTML)
 
         # Очистка
         try:
-            if output_path.exists():
-                output_path.unlink()
             storage.delete(file_id)
             if user_id in storage.user_data:
                 del storage.user_data[user_id]
@@ -1002,6 +3271,64 @@ async def new_video_handler(message: Message):
         parse_mode=ParseMode.HTML
     )
 
+# ===== ВЕБ-СЕРВЕР =====
+async def keep_alive(request: web.Request) -> web.Response:
+    """Keep-alive для Replit"""
+    response = f"🎬 Video Sticker Bot\n⏰ {datetime.now().strftime('%H:%M:%S')}"
+    return web.Response(text=response, content_type='text/plain', charset='utf-8')
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Метрики в формате Prometheus"""
+    storage_stats = storage.stats()
+    outputs = sum(metrics.counters["sticker_outputs_total"].values())
+    oversize = sum(metrics.counters["sticker_outputs_oversize_total"].values())
+    snapshot = {
+        "sticker_render_active": ("gauge", "Занятых слотов рендера", render_scheduler.active),
+        "sticker_render_queued": ("gauge", "Задач в очереди рендера", render_scheduler.queued),
+        "sticker_render_slots": ("gauge", "Слотов рендера", render_scheduler.slots),
+        "sticker_downloads_active": ("gauge", "Идущих скачиваний", admission.active),
+        "sticker_downloads_queued": ("gauge", "Скачиваний в очереди", len(admission.waiting)),
+        "sticker_rate_limit_tracked": ("gauge", "Неполных ведер лимита частоты", rate_limiter.tracked),
+        "sticker_oversize_ratio": ("gauge", "Доля стикеров больше лимита",
+                                   round(oversize / outputs, 6) if outputs else 0),
+        "sticker_storage_files": ("gauge", "Файлов в FileStorage", storage_stats['files']),
+        "sticker_storage_bytes": ("gauge", "Байт в FileStorage", storage_stats['bytes']),
+        "sticker_user_sessions": ("gauge", "Сессий мастера в памяти", storage_stats['user_data']),
+        "sticker_cache_entries": ("gauge", "Записей в кэше рендера", len(render_cache.entries)),
+        "sticker_cache_bytes": ("gauge", "Байт в кэше рендера", render_cache.total_bytes),
+        "sticker_cache_hits_total": ("counter", "Попаданий в кэш рендера", render_cache.hits),
+        "sticker_cache_misses_total": ("counter", "Промахов кэша рендера", render_cache.misses),
+        "sticker_cache_merged_total": ("counter", "Склеенных одинаковых рендеров", render_cache.merged),
+        "sticker_sent_refs": ("gauge", "Запомненных file_id отправленных стикеров", len(render_cache.sent)),
+        "sticker_sent_reused_total": ("counter", "Стикеров, отправленных ссылкой без загрузки",
+                                      render_cache.sent_reused),
+        "sticker_sent_saved_bytes_total": ("counter", "Байт, которые не пришлось загружать в Telegram",
+                                           render_cache.sent_saved_bytes),
+        "sticker_upload_cache_entries": ("gauge", "Исходников в кэше загрузок", len(upload_cache.entries)),
+        "sticker_upload_cache_bytes": ("gauge", "Байт в кэше загрузок", upload_cache.total_bytes),
+        "sticker_upload_cache_hits_total": ("counter", "Повторных загрузок без скачивания", upload_cache.hits),
+        "sticker_upload_cache_misses_total": ("counter", "Загрузок, которые пришлось скачать", upload_cache.misses),
+        "sticker_upload_cache_saved_bytes_total": ("counter", "Байт, которые не пришлось скачивать",
+                                                   upload_cache.bytes_saved),
+    }
+    return web.Response(text=metrics.render(snapshot), content_type='text/plain', charset='utf-8')
+
+def create_web_app() -> web.Application:
+    """aiohttp-приложение: keep-alive и, в режиме webhook, прием апдейтов"""
+    app = web.Application()
+    app.router.add_get("/", keep_alive)
+    app.router.add_get("/metrics", metrics_handler)
+
+    if BOT_MODE == "webhook":
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+
+    return app
+
 # ===== ЗАПУСК БОТА =====
 async def main():
     """Основная функция запуска"""
@@ -1017,27 +3344,73 @@ async def main():
 
     # Очищаем старые файлы
     cleanup()
+    storage.storage_dir.mkdir(exist_ok=True)
+    render_cache.cache_dir.mkdir(parents=True, exist_ok=True)
+    upload_cache.cache_dir.mkdir(parents=True, exist_ok=True)
+    prepare_frame_assets()
+    logger.info(
+        f"💾 Диск: до {(STORAGE_MAX_BYTES + UPLOAD_CACHE_MAX_BYTES + RENDER_CACHE_MAX_BYTES) / 1024 / 1024:.0f}MB "
+        f"(загрузки {STORAGE_MAX_BYTES / 1024 / 1024:.0f} + кэш загрузок "
+        f"{UPLOAD_CACHE_MAX_BYTES / 1024 / 1024:.0f} + кэш рендера {RENDER_CACHE_MAX_BYTES / 1024 / 1024:.0f})"
+    )
+    if PIL_AVAILABLE and TEXT_FONT:
+        logger.info(f"🔤 Текст: картинка через Pillow ({Path(TEXT_FONT).name})")
+    else:
+        # Запасной путь заметно дороже: drawtext рисует текст на каждом кадре
+        reason = "Pillow не установлен (pip install -r requirements.txt)" if not PIL_AVAILABLE \
+            else "шрифт не найден (задайте TEXT_FONT)"
+        logger.warning(f"⚠️ Текст: drawtext на каждом кадре - {reason}")
 
-    # Запускаем keep-alive
-    try:
-        keep_alive_thread = threading.Thread(target=run_keep_alive, daemon=True)
-        keep_alive_thread.start()
-        logger.info("✅ Keep-alive запущен на порту 3000")
-    except Exception as e:
-        logger.error(f"⚠️ Ошибка keep-alive: {e}")
+    # Фоновая очистка хранилища
+    sweeper_task = asyncio.create_task(storage_sweeper())
 
     # Получаем информацию о боте
     me = await bot.get_me()
     logger.info(f"🤖 Бот: @{me.username}")
-    logger.info("✅ Бот запущен!")
+
+    # Веб-сервер в том же event loop: keep-alive (+ webhook)
+    runner = web.AppRunner(create_web_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", WEB_PORT).start()
+    logger.info(f"🌐 Веб-сервер запущен на порту {WEB_PORT}")
 
     # Запускаем бота
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if BOT_MODE == "webhook":
+            webhook_url = WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH
+            await bot.set_webhook(
+                webhook_url,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info(f"✅ Бот запущен (webhook: {webhook_url})")
+            # В polling сигналы перехватывает aiogram, здесь - сами: иначе
+            # SIGTERM только удалил бы файлы, а бот продолжал бы работать
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    loop.add_signal_handler(sig, stop_event.set)
+                except NotImplementedError:
+                    pass  # Windows: остается KeyboardInterrupt
+            await stop_event.wait()
+            logger.info("🛑 Получен сигнал остановки")
+        else:
+            await bot.delete_webhook()
+            logger.info("✅ Бот запущен (polling)")
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except Exception as e:
         logger.error(f"❌ Ошибка запуска бота: {e}")
+    finally:
+        sweeper_task.cancel()
+        await runner.cleanup()
 
 if __name__ == "__main__":
+    # Очистка на выходе - только у запущенного бота: bench.py, loadtest.py
+    # и тесты импортируют модуль и не должны трогать чужой ./temp_files
+    atexit.register(cleanup)
+    signal.signal(signal.SIGTERM, lambda s, f: cleanup())
+
     # Очищаем при запуске
     cleanup()
 
@@ -0,0 +1,256 @@
+# test_main.py - Тесты чистых функций main.py (без сети и без бота)
+#
+#   python3 -m pytest -q            # или: python3 -m unittest test_main
+#
+# Нужны ffmpeg в PATH и зависимости из requirements.txt: без них main.py
+# не импортируется.
+import os
+import sys
+import asyncio
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+
+# main.py требует токен при импорте, но в сеть тесты не ходят
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("BOT_MODE", "polling")
+
+REPO_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(REPO_DIR))
+
+# Импорт main создает ./temp_files - пусть это будет во временной папке
+_work_dir = tempfile.TemporaryDirectory(prefix="sticker_test_")
+_start_dir = os.getcwd()
+os.chdir(_work_dir.name)
+try:
+    import main
+finally:
+    os.chdir(_start_dir)
+
+
+class FrameRasterTest(unittest.TestCase):
+    """Полосы рамки на любом размере кадра, включая вырожденные"""
+
+    def test_tiny_and_extreme_sizes(self):
+        for frame, data in main.FRAMES.items():
+            for width, height in [(512, 2), (512, 4), (512, 10), (2, 512), (10, 512),
+                                  (1, 1), (2, 2), (30, 30)]:
+                with self.subTest(frame=frame, size=(width, height)):
+                    rgba = main.render_frame_rgba(data["bands"], width, height)
+                    self.assertEqual(len(rgba), width * height * 4)
+
+    def test_thin_frame_stays_on_edges(self):
+        # Полоса толщиной 15 на кадре 40x40 не заходит в центр
+        bands = main.FRAMES["fire"]["bands"]
+        width = height = 40
+        rgba = main.render_frame_rgba(bands, width, height)
+        center = ((height // 2) * width + width // 2) * 4
+        self.assertEqual(rgba[center + 3], 0)
+
+    def test_clamped_band_does_not_wrap(self):
+        # Полоса сверху толще кадра: раньше отрицательные индексы
+        # закрашивали пиксели с другого края
+        bands = [("top", 10, (255, 0, 0, 1.0))]
+        rgba = main.render_frame_rgba(bands, 8, 8)
+        alpha = [rgba[(y * 8) * 4 + 3] for y in range(8)]
+        self.assertEqual(alpha, [255] * 4 + [0] * 4)
+
+
+def probed(width: int, height: int) -> dict:
+    """Результат probe_media для непрозрачного H.264 заданного размера"""
+    return {'codec': "h264", 'width': width, 'height': height, 'fps': 30.0,
+            'duration': 3.0, 'alpha': False}
+
+
+class FitGeometryTest(unittest.TestCase):
+    """Режим fit для входа с крайними пропорциями"""
+
+    def test_short_side_has_minimum(self):
+        self.assertEqual(main.output_size(probed(1280, 720)), (512, 288))
+        self.assertEqual(main.output_size(probed(2048, 16)), (512, main.MIN_STICKER_SIDE))
+        self.assertEqual(main.output_size(probed(16, 2048)), (main.MIN_STICKER_SIDE, 512))
+
+    def test_narrow_input_is_padded_with_alpha(self):
+        media = probed(2048, 16)  # Без минимума вышло бы 512x4
+        self.assertEqual(main.fit_size(media), (512, 4))
+        self.assertTrue(any(f.startswith("pad=512:128") for f in main.base_filters(media)))
+        self.assertEqual(main.output_pix_fmt(media), "yuva420p")
+
+    def test_narrow_input_with_frame(self):
+        media = probed(2048, 16)
+        for frame, data in main.FRAMES.items():
+            with self.subTest(frame=frame):
+                graph = main.build_video_filter("none", frame, "", "white", "medium", media=media)
+                if data["bands"]:
+                    self.assertIn(f"{frame}_512x{main.MIN_STICKER_SIDE}.png", graph)
+
+
+
+class RenderSchedulerTest(unittest.TestCase):
+    """Задачи с весом: проход на несколько эффектов занимает несколько слотов"""
+
+    def test_heavy_job_takes_its_slots(self):
+        async def scenario():
+            scheduler = main.RenderScheduler(2)
+            running, overlaps, started = set(), [], []
+
+            def job(name: str):
+                async def work():
+                    if running and (name == "heavy" or "heavy" in running):
+                        overlaps.append((name, set(running)))
+                    running.add(name)
+                    started.append(name)
+                    await asyncio.sleep(0.01)
+                    running.discard(name)
+                    return name
+                return work
+
+            # Пользователь 1 - два легких, 2 - проход на 12 эффектов, 3 - легкий
+            jobs = [(1, "light1", 1), (2, "heavy", 12), (3, "light2", 1), (1, "light3", 1)]
+            results = await asyncio.gather(*(
+                scheduler.run(user, job(name), weight=weight) for user, name, weight in jobs
+            ))
+            return results, overlaps, started, scheduler.active
+
+        results, overlaps, started, active = asyncio.run(scenario())
+        self.assertEqual(results, ["light1", "heavy", "light2", "light3"])
+        self.assertEqual(overlaps, [])
+        # Тяжелую задачу не обгоняют: она следующая по кругу после light1
+        self.assertEqual(started[:2], ["light1", "heavy"])
+        self.assertEqual(active, 0)
+
+
+
+class UserCapTest(unittest.TestCase):
+    """Лимит загрузок на пользователя не трогает только что добавленную"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix="sticker_test_storage_")
+        self.addCleanup(self.tmp.cleanup)
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, _start_dir)
+        self.storage = main.FileStorage()
+
+    def upload(self, user_id: int) -> str:
+        file_id, path = self.storage.allocate(user_id, ".mp4")
+        path.write_bytes(b"video")
+        self.storage.add(file_id, user_id, path)
+        return file_id
+
+    def test_cap_of_one_keeps_new_upload(self):
+        # Одинаковое время обращения у всех загрузок - порядок по uuid случайный
+        with mock.patch.object(main, "MAX_FILES_PER_USER", 1), \
+                mock.patch.object(main.time, "time", return_value=1000.0):
+            for _ in range(5):
+                file_id = self.upload(1)
+                self.assertEqual(list(self.storage.files), [file_id])
+                self.assertTrue(self.storage.files[file_id]['path'].exists())
+
+    def test_cap_keeps_latest_per_user(self):
+        clock = iter(range(1000, 2000))
+        with mock.patch.object(main, "MAX_FILES_PER_USER", 2), \
+                mock.patch.object(main.time, "time", side_effect=lambda: float(next(clock))):
+            first = self.upload(1)
+            other = self.upload(2)
+            second = self.upload(1)
+            third = self.upload(1)
+        self.assertEqual(set(self.storage.files), {other, second, third})
+        self.assertNotIn(first, self.storage.files)
+
+    def test_zero_cap_is_rejected(self):
+        env = dict(os.environ, MAX_FILES_PER_USER="0", PYTHONPATH=str(REPO_DIR))
+        proc = subprocess.run([sys.executable, "-c", "import main"], cwd=self.tmp.name, env=env,
+                              capture_output=True, text=True, timeout=60)
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn("MAX_FILES_PER_USER", proc.stderr)
+
+
+
+class ProbeTest(unittest.TestCase):
+    """Проба входа: ffprobe, его сбой и заголовок ffmpeg дают одно и то же"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory(prefix="sticker_test_probe_")
+        cls.video = Path(cls.tmp.name) / "input.mp4"
+        subprocess.run([
+            main.FFMPEG, "-v", "error", "-y",
+            "-f", "lavfi", "-i", "testsrc2=size=320x240:rate=25:duration=1",
+            "-pix_fmt", "yuv420p", str(cls.video)
+        ], check=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def check(self, media):
+        self.assertIsNotNone(media)
+        self.assertEqual((media['codec'], media['width'], media['height']), ("h264", 320, 240))
+        self.assertAlmostEqual(media['fps'], 25, places=2)
+        self.assertIsNone(main.media_problem(media))
+
+    def test_banner_parser(self):
+        with mock.patch.object(main, "FFPROBE", None):
+            self.check(asyncio.run(main.probe_media(self.video)))
+
+    def test_failing_ffprobe_falls_back_to_banner(self):
+        # ffprobe, который отверг аргументы: код 1 и ничего в stdout
+        with mock.patch.object(main, "FFPROBE", shutil.which("false")):
+            self.check(asyncio.run(main.probe_media(self.video)))
+
+    @unittest.skipUnless(shutil.which("ffprobe"), "ffprobe не установлен")
+    def test_ffprobe_accepts_show_entries(self):
+        self.check(asyncio.run(main.probe_media(self.video)))
+
+
+
+class NormalizeSpanTest(unittest.TestCase):
+    """Промежуточный файл короче самого жадного эффекта, ускоряющие берут исходник"""
+
+    def test_normalized_covers(self):
+        long_input, short_input = probed(1280, 720), probed(1280, 720)
+        long_input['duration'], short_input['duration'] = 10.0, 2.0
+        fast = main.effect_input_span("fast")
+        self.assertGreater(fast, main.NORMALIZE_DURATION)
+        self.assertTrue(main.normalized_covers(long_input, main.effect_input_span("none")))
+        self.assertTrue(main.normalized_covers(long_input, main.effect_input_span("slow")))
+        self.assertFalse(main.normalized_covers(long_input, fast))
+        self.assertTrue(main.normalized_covers(short_input, fast))
+        self.assertFalse(main.normalized_covers(None, fast))
+
+    def test_render_input_by_span(self):
+        async def scenario(tmp: Path):
+            video = tmp / "input.mp4"
+            subprocess.run([
+                main.FFMPEG, "-v", "error", "-y",
+                "-f", "lavfi", "-i", "testsrc2=size=320x240:rate=30:duration=8",
+                "-pix_fmt", "yuv420p", str(video)
+            ], check=True)
+            storage = main.FileStorage()
+            media = await main.probe_media(video)
+            file_id, path = storage.allocate(1, ".mp4")
+            shutil.copy(video, path)
+            storage.add(file_id, 1, path, media=media)
+            await storage.start_normalize(file_id)
+            normalized = await main.probe_media(storage.files[file_id]['normalized_path'])
+            return (normalized['duration'],
+                    await storage.render_input(file_id, main.effect_input_span("none")),
+                    await storage.render_input(file_id, main.effect_input_span("fast")))
+
+        with tempfile.TemporaryDirectory(prefix="sticker_test_norm_") as tmp:
+            os.chdir(tmp)
+            try:
+                duration, plain, fast = asyncio.run(scenario(Path(tmp)))
+            finally:
+                os.chdir(_start_dir)
+        self.assertAlmostEqual(duration, main.NORMALIZE_DURATION, delta=0.1)
+        self.assertTrue(plain[1] and plain[0].name.endswith("_norm.mkv"))
+        self.assertFalse(fast[1])
+        self.assertTrue(fast[0].name.endswith(".mp4"))
+
+
+if __name__ == "__main__":
+    unittest.main()